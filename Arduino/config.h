@@ -27,6 +27,7 @@
 #define BUFFER_SIZE 131072U // Buffer size for image processing
 
 #define SERVER_BASE_URL "http://server.ip:15001"
+#define EPD_PANEL "epd7in3f" // Panel profile sent to the server (see panels.py)
 #define PREFERENCES_SLEEP_TIME_KEY "refresh_rate"
 #define PREFERENCES_LAST_SLEEP_TIME "last_sleep"
 #define PREFERENCES_CONNECT_API_RETRY_COUNT "retry_count"
@@ -28,6 +28,9 @@ SETTING       <>  2  // Configuration mode trigger pin
 
 Preferences preferences;
 
+// Hash of the frame on the display, kept in RTC memory across deep sleep
+RTC_DATA_ATTR char lastFrameHash[17] = "";
+
 class EpaperManager
 {
 private:
@@ -45,22 +48,18 @@ private:
     WiFiClient *basicClient = nullptr;
     WiFiClientSecure *secureClient = nullptr;
     HTTPClient http;
-    HTTPClient sleepHttp; // New HTTP client for sleep request
     http.setTimeout(HTTP_TIMEOUT);
 
-    // Parse base URL for sleep request
-    String baseUrl = imageUrl;
-    const char *downloadPath = "/download";
-    const char *sleepPath = "/sleep";
-
-    String sleepUrl = baseUrl + sleepPath;
+    // Frame and sleep duration come back in one request, saving a second handshake
+    const char *framePath = "/frame";
+    const char *headerKeys[] = {"X-Sleep-Duration", "X-Frame-Hash", "X-Commands"};
 
     // Setup client for image download
     if (isHttps)
     {
       secureClient = new WiFiClientSecure;
       secureClient->setInsecure();
-      if (!http.begin(*secureClient, imageUrl + downloadPath))
+      if (!http.begin(*secureClient, imageUrl + framePath))
       {
         Serial.println("Failed to initialize HTTPS connection");
         delete secureClient;
@@ -70,7 +69,7 @@ private:
     else
     {
       basicClient = new WiFiClient;
-      if (!http.begin(*basicClient, imageUrl + downloadPath))
+      if (!http.begin(*basicClient, imageUrl + framePath))
       {
         Serial.println("Failed to initialize HTTP connection");
         delete basicClient;
@@ -88,6 +87,16 @@ private:
     }
     int batteryVoltage = (plusV / 50) * 2;
     http.addHeader("batteryCap", String(batteryVoltage));
+    http.addHeader("panel", EPD_PANEL);
+    // Lets the server hand a retry the photo it picked for this frame
+    http.addHeader("device", WiFi.macAddress());
+
+    // Server answers 304 when the frame on the display is still current
+    if (lastFrameHash[0] != '\0')
+    {
+      http.addHeader("If-None-Match", lastFrameHash);
+    }
+    http.collectHeaders(headerKeys, sizeof(headerKeys) / sizeof(headerKeys[0]));
 
     // Download and process image
     bool success = false;
@@ -102,56 +111,28 @@ private:
       {
         int httpCode = http.GET();
 
+        // Every answer carries the wake schedule, errors included
+        if (http.hasHeader("X-Sleep-Duration"))
+        {
+          sleepDuration = http.header("X-Sleep-Duration").toInt() / 1000; // Convert to seconds
+        }
+
         if (httpCode == HTTP_CODE_OK)
         {
           success = processImageData(&http);
-
-          // After successful image download, get sleep duration
           if (success)
           {
-            // Setup new client for sleep request
-            WiFiClient *sleepBasicClient = nullptr;
-            WiFiClientSecure *sleepSecureClient = nullptr;
-
-            if (isHttps)
-            {
-              sleepSecureClient = new WiFiClientSecure;
-              sleepSecureClient->setInsecure();
-              sleepHttp.begin(*sleepSecureClient, sleepUrl);
-            }
-            else
-            {
-              sleepBasicClient = new WiFiClient;
-              sleepHttp.begin(*sleepBasicClient, sleepUrl);
-            }
-
-            sleepHttp.addHeader("Accept", "application/json");
-            int sleepHttpCode = sleepHttp.GET();
-
-            if (sleepHttpCode == HTTP_CODE_OK)
-            {
-              String payload = sleepHttp.getString();
-              StaticJsonDocument<200> doc;
-              DeserializationError error = deserializeJson(doc, payload);
-
-              if (!error)
-              {
-                sleepDuration = doc["sleep_duration"] | 0;
-                if (sleepDuration > 0)
-                {
-                  sleepDuration /= 1000; // Convert to seconds
-                }
-              }
-            }
-
-            sleepHttp.end();
-            if (sleepSecureClient)
-              delete sleepSecureClient;
-            if (sleepBasicClient)
-              delete sleepBasicClient;
+            strlcpy(lastFrameHash, http.header("X-Frame-Hash").c_str(), sizeof(lastFrameHash));
           }
           break;
         }
+        else if (httpCode == HTTP_CODE_NOT_MODIFIED)
+        {
+          Serial.println("Frame unchanged, skipping refresh");
+          epd.Sleep();
+          success = true;
+          break;
+        }
         else if (httpCode == HTTP_CODE_ACCEPTED)
         {
           Serial.println("Server processing, waiting...");
@@ -182,7 +163,7 @@ private:
       delete basicClient;
 
     // If we got a valid sleep duration, use it for hibernation
-    if (success && sleepDuration > 0)
+    if (sleepDuration > 0)
     {
       hibernate(sleepDuration);
     }
@@ -387,6 +368,7 @@ public:
     {
       Serial.println(F("Config button pressed, entering config mode..."));
       epd.Clear(EPD_7IN3F_WHITE);
+      lastFrameHash[0] = '\0';
       // epd.Sleep();
 
       bool res = WifiCaptivePortal.startPortal();
@@ -483,6 +465,7 @@ public:
     epd.Init();
     delay(1000);
     epd.Clear(EPD_7IN3F_WHITE);
+    lastFrameHash[0] = '\0';
     epd.Sleep();
   }
 };
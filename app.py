@@ -1,20 +1,28 @@
 #-*- coding:utf8 -*-
-from flask import Flask, jsonify, send_file, render_template, request, redirect, url_for
+from flask import Flask, jsonify, send_file, render_template, request, redirect, url_for, make_response
 import yaml
 import requests
 import os
 import io
-import random
-import rawpy
 import numpy as np
-from PIL import Image,ImageDraw,ImageFont,ImageEnhance,ImageOps
-from pillow_heif import register_heif_opener
+from PIL import Image,ImageEnhance,ImageOps
 from datetime import datetime, timedelta
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import threading
-from cpy import  convert_image, load_scaled
-import ntplib
+import contextlib
+import hashlib
+from engine import dither_indices, dither_ordered, load_scaled
+from memory_budget import (STRIP_ROWS, admitted_render, budget_enabled,
+                           estimate_render_bytes, frame_buffers, memory_status)
+from selection import SelectionEngine, album_fingerprint, parse_album_setting
+from panels import DEFAULT_PANEL, PANEL_PROFILES, get_panel
+from local_source import LOCAL_ALBUM_ID, start_local_index
+from overlays import LOW_BATTERY, OVERLAY_NAMES, draw_overlays
+from ordered_dither import DITHER_MODES, ORDERED_MODES, palette_lut, threshold_offsets
+from singleflight import SingleFlight
+from frame_store import FrameStore
+from warmup import WarmupJob
 import time
 
 app = Flask(__name__)
@@ -28,6 +36,7 @@ DEFAULT_CONFIG = {
         'enhanced': 1.3,                # From 0.0 .. 1.0
         'contrast': 0.9,                # From 0.0 .. 1.0
         'strength': 0.8,                # From 0.0 .. 1.0
+        'dither_mode': 'diffusion',     # Dithering mode (diffusion/bayer/bluenoise)
         'display_mode': 'fill',          # Add display mode setting (fit/fill)
         'image_order': 'random',        # Add image display order setting (random/newest)
         'sleep_start_hour': 23,         # Sleep start time 23:00 (11:00 PM)
@@ -35,6 +44,9 @@ DEFAULT_CONFIG = {
         'sleep_end_hour': 6,            # Sleep end time 6:00 (6:00 AM)
         'sleep_end_minute': 0,          # Sleep end time 6:00 (6:00 AM)
         'wakeup_interval': 60,          # Default 60 minutes (1 hour)
+        'panel': DEFAULT_PANEL,         # Panel profile when the device sends no panel header
+        'source': 'immich',             # Photo source (immich/local)
+        'overlays': [],                 # Captions drawn on the frame (date/battery/status)
     }
 }
 
@@ -47,341 +59,313 @@ rotationAngle = DEFAULT_CONFIG['immich']['rotation']
 img_enhanced = DEFAULT_CONFIG['immich']['enhanced']
 img_contrast = DEFAULT_CONFIG['immich']['contrast']
 strength = DEFAULT_CONFIG['immich']['strength']
+dither_mode = DEFAULT_CONFIG['immich']['dither_mode']
 display_mode = DEFAULT_CONFIG['immich']['display_mode']
 image_order = DEFAULT_CONFIG['immich']['image_order']
 sleep_start_hour = DEFAULT_CONFIG['immich']['sleep_start_hour']
 sleep_start_minute = DEFAULT_CONFIG['immich']['sleep_start_minute']
 sleep_end_hour = DEFAULT_CONFIG['immich']['sleep_end_hour']
 sleep_end_minute = DEFAULT_CONFIG['immich']['sleep_end_minute']
+panel_name = DEFAULT_CONFIG['immich']['panel']
+photo_source = DEFAULT_CONFIG['immich']['source']
+enabled_overlays = DEFAULT_CONFIG['immich']['overlays']
 
 # Retrieve environment variables with error handling
 apikey = os.getenv('IMMICH_API_KEY')
 photodir = os.getenv('IMMICH_PHOTO_DEST', '/photos')
-tracking_file = os.path.join(photodir, 'tracking.txt')
 
 # Ensure directory exists
 os.makedirs(photodir, exist_ok=True)
 
-# Ensure tracking.txt exists
-if not os.path.exists(tracking_file):
-    open(tracking_file, 'w').close()
+# Persisted play order and cursor of every album
+selection_engine = SelectionEngine(os.path.join(photodir, 'selection'))
+
+# Concurrent identical renders and Immich album fetches run only once
+render_flight = SingleFlight()
+album_flight = SingleFlight()
+
+# Seconds an Immich API call may take
+IMMICH_TIMEOUT = float(os.getenv('IMMICH_TIMEOUT', '30'))
+
+# Photo claimed by every device whose frame was not delivered yet, so its
+# retry shows the same photo and joins the render while it still runs
+device_claims = {}
+device_claims_lock = threading.Lock()
+
+# Dithered frames rendered by wakes and the warm-up job
+frame_store = FrameStore(os.path.join(photodir, 'selection', 'frames'))
+warmup_job = WarmupJob(os.path.join(photodir, 'selection', 'warmup.json'), frame_store)
+
+# Panels announced by frames since startup, warmed up next to the configured one
+seen_panels = set()
+
+# Nightly warm-up of the album, set WARMUP_NIGHTLY=0 to turn it off
+WARMUP_NIGHTLY = os.getenv('WARMUP_NIGHTLY', '1') == '1'
+
+# Directory served by the local photo source, indexed on first use
+localdir = os.getenv('LOCAL_PHOTO_DIR', photodir)
+local_index = None
+local_index_lock = threading.Lock()
 
 headers = {
     'Accept': 'application/json',
     'x-api-key': apikey
 }
 
-# Allowed file extensions
-ALLOWED_EXTENSIONS = {'.jpeg', '.raw', '.jpg', '.bmp', '.dng', '.heic', '.arw', '.cr2', '.dng', '.nef', '.raw'}
-
 # Set up the directory for the downloaded images
 os.makedirs(photodir, exist_ok=True)
-register_heif_opener()
-
-# Palltte only for WaveShare 7.5inch ACeP e-Paper
-palette = [
-    (0, 0, 0), #Black
-    (255, 255, 255), #White
-    (67, 138, 28), #Green
-    (100, 64, 255), #Blue
-    (191, 0, 0), #Red
-    (255, 243, 56), #Yellow
-    (232, 126 ,0) #Orange
-]
+
+# HEIF support is registered on the first HEIC photo, see register_heif()
+heif_registered = False
 
 last_battery_voltage = 0
 last_battery_update = 0
 
-def load_downloaded_images():
-    """ Load downloaded image ID from tracking.txt """
-    global albumname
-    try:
-        # Ensure file exists and is readable/writable
-        if not os.path.exists(tracking_file):
-            open(tracking_file, 'w').close()
-        
-        # Ensure file has correct permissions
-        os.chmod(tracking_file, 0o666)
-        
-        with open(tracking_file, 'r+') as f:
-            lines = f.readlines()
-            
-            # If file is empty or first line is not current album name, return empty set
-            if not lines or lines[0].strip() != albumname:
-                # Rewrite album name
-                f.seek(0)
-                f.truncate()
-                f.write(f"{albumname}\n")
-                return set()
-            
-            # Return all lines except the first as downloaded image IDs
-            return set(line.strip() for line in lines[1:] if line.strip())
-    except Exception as e:
-        print(f"Error reading tracking file: {e}")
-        return set()
+def depalette_image(pixels, palette, out=None):
+    """
+    Map RGB pixels to palette indices
 
-def save_downloaded_image(asset_id):
-    """ Save downloaded image ID from tracking.txt """
-    global albumname
-    try:
-        # Check the file exists and is writable
-        if not os.path.exists(tracking_file):
-            open(tracking_file, 'w').close()
-        
-        # Check the permission of the file
-        os.chmod(tracking_file, 0o666)
-        
-        with open(tracking_file, 'r+') as f:
-            # Read all lines
-            lines = f.readlines()
-            
-            # If file is empty or first line is not current album name, reset file
-            if not lines or lines[0].strip() != albumname:
-                f.seek(0)
-                f.truncate()
-                f.write(f"{albumname}\n")
-            else:
-                f.seek(0, 2)  # Move to the end of the file
-            
-            # Add new image ID
-            f.write(f"{asset_id}\n")
-    except PermissionError:
-        print(f"Permission denied when writing to {tracking_file}")
-    except IOError as e:
-        print(f"IO Error when writing to tracking file: {e}")
-    except Exception as e:
-        print(f"Unexpected error writing to tracking file: {e}")
+    Works on strips of STRIP_ROWS rows so the per-color distance array stays a
+    few MB instead of broadcasting over the whole frame at once.
+    :param pixels: (H, W, 3) array
+    :param palette: list of RGB tuples
+    :param out: optional preallocated (H, W) uint8 array
+    :return: (H, W) uint8 array of palette indices
+    """
+    palette_array = np.array(palette, dtype=np.int32)
+    height, width = pixels.shape[:2]
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint8)
+    for top in range(0, height, STRIP_ROWS):
+        strip = pixels[top:top + STRIP_ROWS, :, :3].astype(np.int32)
+        # Squared distance keeps the same argmin as the euclidean distance
+        diffs = np.sum((strip[:, :, None, :] - palette_array[None, None, :, :]) ** 2, axis=3)
+        out[top:top + STRIP_ROWS] = np.argmin(diffs, axis=2)
+    #indices[indices > 3] += 1  # Simulate the code from the C
+    return out
 
-def reset_tracking_file():
-    """Reset tracking.txt file"""
-    try:
-        open(tracking_file, 'w').close()
-    except Exception as e:
-        print(f"Error resetting tracking file: {e}")
+def register_heif():
+    """ Import pillow_heif and register the HEIF opener on first use """
+    global heif_registered
+    if not heif_registered:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+        heif_registered = True
 
+def decode_image(image_data, original_path, panel=None):
+    """
+    Decode downloaded image data to a PIL image based on its type
 
-def depalette_image(pixels, palette):
-    palette_array = np.array(palette)
-    diffs = np.sqrt(np.sum((pixels[:, :, None, :] - palette_array[None, None, :, :]) ** 2, axis=3))
-    indices = np.argmin(diffs, axis=2)
-    #indices[indices > 3] += 1  # Simulate the code from the C
-    return indices
+    In the memory-budgeted mode RAW files are demosaiced at half size and
+    JPEGs are decoded at a reduced scale, both still larger than the panel.
+    """
+    panel = panel or get_panel(panel_name)
+    path = original_path.lower()
+    if path.endswith(('.raw', '.dng', '.arw', '.cr2', '.nef')):
+        import rawpy
+        with rawpy.imread(image_data) as raw:
+            rgb = raw.postprocess(use_camera_wb=True, use_auto_wb=False, half_size=budget_enabled())
+        return Image.fromarray(rgb)
+    if path.endswith('.heic'):
+        register_heif()
+        return Image.open(image_data).convert("RGB")
+    image = Image.open(image_data)
+    if budget_enabled():
+        # Both sides must stay above the panel size whatever the rotation
+        side = max(panel.width, panel.height)
+        image.draft('RGB', (side, side))
+    return image
 
-def scale_img_in_memory(image, target_width=800, target_height=480, bg_color=(255, 255, 255)):
+def render_frame(image, buffers=None, profile=None, panel=None):
     """
-    Process image in memory, return BytesIO object
+    Scale, enhance and dither an image for the e-paper
 
     :param image: PIL Image object
-    :param target_width: width of epaper
-    :param target_height: height of epaper
-    :param bg_color: background color
-    :param rotation: rotation angle (0, 90, 180, 270)
-    :return: BytesIO object
+    :param buffers: optional FrameBuffers reused across requests
+    :param profile: optional RenderProfile recording peak memory per stage
+    :param panel: PanelProfile, the configured panel when omitted
+    :return: (panel.height, panel.width) uint8 array of palette indices
     """
+    panel = panel or get_panel(panel_name)
+    stage = profile.stage if profile else (lambda name: contextlib.nullcontext())
 
-    # Update the angle
-    rotation = rotationAngle
+    with stage('scale'):
+        # Read correct photo orientation from EXIF
+        image = ImageOps.exif_transpose(image)
+        img = load_scaled(image, rotationAngle, display_mode, panel.width, panel.height)
+        del image
 
-    # Get data from EXIF
-    try:
-        exif = image._getexif()
-        if exif:
-            # EXIF time tag is 36867
-            date_time = exif.get(36867)
-            if not date_time:
-                # Alternative time tag is 306
-                date_time = exif.get(306)
-        else:
-            date_time = None
-    except:
-        date_time = None
-
-    # Read correct photo orientation from EXIF
-    image = ImageOps.exif_transpose(image)
-    # output_img = Image.new('RGB', (target_width, target_height), bg_color)
-
-    # # calculate position
-    # paste_x = (target_width - new_width) // 2
-    # paste_y = (target_height - new_height) // 2
-    img = load_scaled(image, rotation, display_mode)
-    # Enhance color and contrast
-    enhanced_img = ImageEnhance.Color(img).enhance(img_enhanced)
-    enhanced_img = ImageEnhance.Contrast(enhanced_img).enhance(img_contrast)
-    
-    # Palette definition (matching previous quantization logic)
-    palette = [
-        0, 0, 0,        # Black
-        255, 255, 255,  # White
-        0, 255, 0,      # Green
-        0, 0, 255,      # Blue
-        255, 0, 0,      # Red
-        255, 255, 0,    # Yellow
-        255, 165, 0     # Orange
-    ]
-    
-    # Prepare palette image (similar to previous code)
-    e = len(palette)
-    assert e > 0, "Palette unexpectedly short"
-    assert e <= 768, "Palette unexpectedly long"
-    assert e % 3 == 0, "Palette not multiple of 3, so not RGB"
-
-    # Create temporary palette image
-    pal_image = Image.new("P", (1, 1))
-    
-    # Zero-pad palette to 768 values
-    palette += (768 - e) * [0]
-    pal_image.putpalette(palette)
-    
-    # Quantize image
-    # output_img = enhanced_img.convert("RGB").quantize(
-    #     palette=pal_image,
-    #     dither=Image.Dither.FLOYDSTEINBERG
-    # ).convert("RGB")
-    
-    output_img = convert_image(enhanced_img, dithering_strength=strength)
-    output_img = Image.fromarray(output_img, mode="RGB")
-    
-    # output_img.paste(quantized_img, (paste_x, paste_y))
-    
-    # Add date if available
-    if date_time:
-        draw = ImageDraw.Draw(output_img)
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 20)
-        except:
-            font = ImageFont.load_default()
-        
-        # Format the date
-        try:
-            try:
-                dt = datetime.strptime(date_time, "%Y:%m:%d %H:%M:%S")
-                formatted_time = dt.strftime("%Y/%m/%d")
-            except ValueError:
-                dt = datetime.strptime(date_time, "%Y.%m.%d")
-                formatted_time = dt.strftime("%Y/%m/%d")
-        except:
-            formatted_time = date_time
-
-        def draw_text_with_background(draw, text, font, text_color=(255, 255, 255), bg_color=(0, 0, 0)):
-            # Calculate rotated width/height
-            if rotation in [90, 270]:
-                img_width, img_height = target_height, target_width  # width and height swapped
-            else:
-                img_width, img_height = target_width, target_height
-        
-            # Set text position
-            if rotation == 0:  # no rotation
-                position = (img_width - 200, img_height - 40)
-            elif rotation == 90:  # 90 degrees clockwise (actually counterclockwise)
-                position = (img_height - 30, 30)
-            elif rotation == 180:  # 180 degrees
-                position = (img_width -200 , img_height - 40)
-            elif rotation == 270:  # 270 degrees clockwise (actually counterclockwise)
-                position = (30, img_width - 30)
-        
-            # Get text bounding box
-            text_bbox = draw.textbbox((0, 0), text, font=font)  # use (0, 0) to get text size
-            text_width = text_bbox[2] - text_bbox[0]
-            text_height = text_bbox[3] - text_bbox[1]
-            padding = 5
-        
-            # Set text position and background rectangle bounds
-            if rotation == 0:  # no rotation, bottom right
-                position = (img_width - text_width - 40, img_height - text_height - 40)
-                rect_coords = [
-                    position[0] - padding,  # Top left X
-                    position[1] - padding,  # Top left Y
-                    position[0] + text_width + padding,  # Bottom right X
-                    position[1] + text_height + padding  # Bottom right Y
-                ]
-            elif rotation == 90:  # 90 degrees, top right
-                position = (img_height - text_height - 40, 40)
-                rect_coords = [
-                    position[0] - padding,  # Top left X
-                    position[1] - padding,  # Top left Y
-                    position[0] + text_height + padding,  # Bottom right X
-                    position[1] + text_width + padding   # Bottom right Y
-                ]
-            elif rotation == 180:  # 180 degrees, top left
-                position = (40, 40)
-                rect_coords = [
-                    position[0] - padding,  # Top left X
-                    position[1] - padding,  # Top left Y
-                    position[0] + text_width + padding,  # Bottom right X
-                    position[1] + text_height + padding  # Bottom right Y
-                ]
-            elif rotation == 270:  # 270 degrees, bottom left
-                position = (40, img_width - text_width - 40)
-                rect_coords = [
-                    position[0] - padding,  # Top left X
-                    position[1] - padding,  # Top left Y
-                    position[0] + text_height + padding,  # Bottom right X
-                    position[1] + text_width + padding   # Bottom right Y
-                ]
-            
-            # Draw rectangular background
-            draw.rectangle(rect_coords, fill=bg_color)
-        
-            # Create text based on the rotation of image
-            if rotation == 0:
-                draw.text(position, text, fill=text_color, font=font)
-            else:
-                # Create a new image to draw rotated text
-                rotated_text = Image.new("RGB", (text_width, text_height), (255, 255, 255))  # white background
-                rotated_draw = ImageDraw.Draw(rotated_text)
-                rotated_draw.text((0, 0), text, fill=text_color, font=font)
-                
-                # Rotate text image
-                rotated_text = rotated_text.rotate(rotation, expand=True, resample=Image.BICUBIC)
-                
-                # Calculate where rotated text should be pasted
-                if rotation == 90:
-                    # 90 degree rotation, display in top right
-                    output_img.paste(rotated_text, (position[1], position[0]))
-                elif rotation == 180:
-                    # 180 degree rotation, display in top left
-                    output_img.paste(rotated_text, (position[0], position[1]))
-                elif rotation == 270:
-                    # 270 degree rotation, display in bottom left
-                    output_img.paste(rotated_text, (position[1], position[0]))
-                
-        # Drawing the text on forground (WIP)
-        # draw_text_with_background(draw, formatted_time, font)
-    
-    # Save image into ram
-    img_io = io.BytesIO()
-    output_img.save(img_io, 'BMP')
-    img_io.seek(0)
-    return img_io
-
-def convert_to_c_code_in_memory(image_data):
-    """ Convert image to C code in memory """
+    with stage('enhance'):
+        # Enhance color and contrast
+        enhanced_img = ImageEnhance.Color(img).enhance(img_enhanced)
+        del img
+        enhanced_img = ImageEnhance.Contrast(enhanced_img).enhance(img_contrast)
+
+    with stage('dither'):
+        if dither_mode in ORDERED_MODES:
+            # Ordered dithering, each pixel independent of its neighbours
+            return dither_ordered(enhanced_img, palette_lut(panel.colors), threshold_offsets(dither_mode, strength),
+                                  out=buffers.indices if buffers is not None else None)
+        if buffers is not None:
+            return dither_indices(enhanced_img, panel.colors, strength,
+                                  out=buffers.indices, work=buffers.work)
+        return dither_indices(enhanced_img, panel.colors, strength)
+
+def fetch_immich_json(api_url):
+    """
+    Fetch JSON from the Immich API, concurrent wakes share one request
+
+    :return: (status code, parsed JSON or None)
+    """
+    def fetch():
+        response = requests.get(api_url, headers=headers, timeout=IMMICH_TIMEOUT)
+        return response.status_code, response.json() if response.status_code == 200 else None
+    return album_flight.do(api_url, fetch)
+
+def render_fingerprint(panel):
+    """ Settings that change the dithered frame, overlays are drawn per request """
+    return (panel.name, rotationAngle, display_mode, img_enhanced, img_contrast, strength, dither_mode)
+
+def stored_frame_id(asset):
+    """ Frame store ID of a photo, changes when the photo file is replaced """
+    modified = asset.get('fileModifiedAt')
+    if not modified:
+        return asset['id']
+    return f"{asset['id']}-{hashlib.sha1(str(modified).encode()).hexdigest()[:8]}"
+
+def device_key():
+    """
+    Frame that sent the request, by its device header (MAC address)
+
+    None for older firmware: behind a proxy or NAT frames share an address,
+    so it cannot tell a retry from another frame.
+    """
+    return request.headers.get('device') or None
+
+def release_claim(device, claim):
+    """ Forget a device's claimed photo, unless a newer request replaced it """
+    with device_claims_lock:
+        if claim is not None and device_claims.get(device) is claim:
+            del device_claims[device]
+
+def get_local_index():
+    """ Index of the local photo directory, scanned and watched from the first call on """
+    global local_index
+    with local_index_lock:
+        if local_index is None:
+            local_index, _ = start_local_index(localdir, os.path.join(photodir, 'selection', 'local_index.db'),
+                                               exclude=[os.path.join(photodir, 'selection')])
+        return local_index
+
+def select_local_photo(image_order):
+    """ Claim the next photo of the local directory, None when it holds no photos """
+    index = get_local_index()
+    for attempt in range(2):
+        fingerprint = index.fingerprint()
+        if selection_engine.needs_sync(LOCAL_ALBUM_ID, fingerprint, image_order):
+            selection_engine.sync(LOCAL_ALBUM_ID, index.assets(), fingerprint, image_order)
+        asset_id = selection_engine.advance(LOCAL_ALBUM_ID)
+        if asset_id is None:
+            return None
+        asset = index.asset(asset_id)
+        if asset is not None and os.path.exists(asset['originalPath']):
+            return asset
+        # Deleted before the watcher caught up, drop it and pick again
+        if asset is not None:
+            index.remove(asset['originalPath'])
+        selection_engine.invalidate(LOCAL_ALBUM_ID)
+    return None
+
+def warmup_assets():
+    """ (source, assets) of every photo the frames can show, for the warm-up job """
+    source = photo_source
+    if source == 'local':
+        return source, get_local_index().assets()
+
+    status_code, data = fetch_immich_json(f"{url}/api/albums")
+    if status_code != 200:
+        raise RuntimeError("Failed to fetch albums")
+    assets = {}
+    for name, _ in parse_album_setting(albumname, [item['albumName'] for item in data]):
+        album = next((item for item in data if item['albumName'] == name), None)
+        if not album:
+            print(f"Warm-up: album {name} not found")
+            continue
+        status_code, album_details = fetch_immich_json(f"{url}/api/albums/{album['id']}")
+        if status_code != 200:
+            raise RuntimeError(f"Failed to fetch album details of {name}")
+        for asset in album_details.get('assets') or []:
+            if asset.get('type') != 'VIDEO':
+                assets[asset['id']] = asset
+    return source, list(assets.values())
+
+def warmup_fetch(source, asset):
+    """ Original of a photo for warmup_render(), local photos are read by the render process """
+    if source == 'local':
+        return asset['originalPath']
+    response = requests.get(f"{url}/api/assets/{asset['id']}/original", headers=headers, timeout=IMMICH_TIMEOUT)
+    if response.status_code != 200:
+        raise RuntimeError(f"Failed to download image ({response.status_code})")
+    return response.content
+
+def warmup_render(image_data, original_path, panel_names):
+    """
+    Decode a photo once and render it for every panel, run in the warm-up processes
+
+    :return: list of (panel.height, panel.width) uint8 arrays of palette indices
+    """
+    if isinstance(image_data, bytes):
+        image_data = io.BytesIO(image_data)
+    panels = [get_panel(name) for name in panel_names]
+    image = decode_image(image_data, original_path, max(panels, key=lambda panel: panel.width * panel.height))
+    return [render_frame(image, panel=panel) for panel in panels]
+
+def start_warmup(trigger='manual'):
+    """ Warm up the configured album for the configured panel and the panels seen since startup """
+    names = [panel_name] + sorted(seen_panels - {panel_name})
+    fingerprints = [render_fingerprint(get_panel(name)) for name in names]
+    # Frames of outdated settings are never served again
+    frame_store.prune(fingerprints)
+    # One decode, then a frame for every panel
+    frame_pixels = sum(get_panel(name).width * get_panel(name).height for name in names)
+    return warmup_job.start(warmup_assets, warmup_fetch, warmup_render, fingerprints, frame_id=stored_frame_id,
+                            estimate=lambda asset: estimate_render_bytes(asset, frame_pixels),
+                            initializer=update_app_config, initargs=(current_config,), trigger=trigger)
+
+# "XX," text for every byte value, used to format packed pixels without Python loops
+HEX_TABLE = np.frombuffer(b''.join(b'%02X,' % i for i in range(256)), dtype=np.uint8).reshape(256, 3)
+
+def convert_to_c_code_in_memory(image_data, buffers=None, panel=None):
+    """
+    Convert image to C code in memory
+
+    :param image_data: RGB image, or a (H, W) array of palette indices from render_frame()
+    :param buffers: optional FrameBuffers reused across requests
+    :param panel: PanelProfile, the configured panel when omitted
+    """
+    panel = panel or get_panel(panel_name)
     # Convert image data to numpy array
-    pixels = np.array(image_data)
+    pixels = np.asarray(image_data)
     
     # Process palette
-    indices = depalette_image(pixels, palette)
-    
-    # Compress pixels
-    height, width = indices.shape
-    bytes_array = [
-        (indices[y, x] << 4) | indices[y, x + 1] if x + 1 < width else (indices[y, x] << 4)
-        for y in range(height)
-        for x in range(0, width, 2)
-    ]
+    if pixels.ndim == 2:
+        indices = pixels
+    else:
+        indices = depalette_image(pixels, panel.display_palette, out=buffers.indices if buffers is not None else None)
     
-    # Generate C code
-    output = io.StringIO()
-
-    for i, byte_value in enumerate(bytes_array):
-        output.write(f"{byte_value:02X},")
-        if (i + 1) % 16 == 0:
-            output.write("\n")
+    # Compress pixels with the panel's packing kernel
+    bytes_array = panel.pack(indices, out=buffers.packed if buffers is not None else None)
     
-    output.write("};\n")
+    # Generate C code, 16 values per line
+    count = bytes_array.size
+    full_lines = count // 16
+    text = HEX_TABLE[bytes_array]
+    lines = np.empty((full_lines, 49), dtype=np.uint8)
+    lines[:, :48] = text[:full_lines * 16].reshape(full_lines, 48)
+    lines[:, 48] = ord("\n")
     
     # Convert output to bytes
-    result = output.getvalue().encode('utf-8')
+    result = lines.tobytes() + text[full_lines * 16:].tobytes() + b"};\n"
     output_bytes = io.BytesIO(result)
     output_bytes.seek(0)
     
@@ -389,6 +373,7 @@ def convert_to_c_code_in_memory(image_data):
 
 def convert_raw_or_dng_to_jpg(input_file_path, output_dir):
     """Convert RAW or DNG files to JPG using rawpy."""
+    import rawpy
     with rawpy.imread(input_file_path) as raw:
         rgb = raw.postprocess(use_camera_wb=True, use_auto_wb=False)
         base_name = os.path.splitext(os.path.basename(input_file_path))[0]
@@ -398,6 +383,7 @@ def convert_raw_or_dng_to_jpg(input_file_path, output_dir):
 
 def convert_heic_to_jpg(input_file_path, output_dir):
     """Convert heic files to JPG using rawpy."""
+    register_heif()
     img = Image.open(input_file_path)
     img = img.convert("RGB")
     base_name = os.path.splitext(os.path.basename(input_file_path))[0]
@@ -462,7 +448,7 @@ class ConfigFileHandler(FileSystemEventHandler):
     
 def update_app_config(new_config):
     """ Update global configuration and Flask application configuration """
-    global current_config, url, albumname, rotationAngle, img_enhanced, img_contrast, strength, display_mode, image_order, sleep_start_hour, sleep_end_hour, sleep_start_minute, sleep_end_minute
+    global current_config, url, albumname, rotationAngle, img_enhanced, img_contrast, strength, dither_mode, display_mode, image_order, sleep_start_hour, sleep_end_hour, sleep_start_minute, sleep_end_minute, panel_name, photo_source, enabled_overlays
     
     current_config = new_config
     
@@ -473,12 +459,16 @@ def update_app_config(new_config):
     app.config['IMMICH_ENHANCED'] = new_config['immich']['enhanced']
     app.config['IMMICH_CONTRAST'] = new_config['immich']['contrast']
     app.config['IMMICH_STRENGH'] = new_config['immich']['strength']
+    app.config['IMMICH_DITHER_MODE'] = new_config['immich'].get('dither_mode', 'diffusion')
     app.config['IMMICH_DISPLAY_MODE'] = new_config['immich']['display_mode']
     app.config['IMMICH_IMAGE_ORDER'] = new_config['immich']['image_order']
     app.config['IMMICH_SLEEP_START_HOUR'] = new_config['immich']['sleep_start_hour']
     app.config['IMMICH_SLEEP_END_HOUR'] = new_config['immich']['sleep_end_hour']
     app.config['IMMICH_SLEEP_START_MINUTE'] = new_config['immich']['sleep_start_minute']
     app.config['IMMICH_SLEEP_END_MINUTE'] = new_config['immich']['sleep_end_minute']
+    app.config['IMMICH_PANEL'] = new_config['immich'].get('panel', DEFAULT_PANEL)
+    app.config['IMMICH_SOURCE'] = new_config['immich'].get('source', 'immich')
+    app.config['IMMICH_OVERLAYS'] = new_config['immich'].get('overlays', [])
 
     
     # Update global variables
@@ -488,14 +478,18 @@ def update_app_config(new_config):
     img_enhanced = new_config['immich']['enhanced']
     img_contrast = new_config['immich']['contrast']
     strength = new_config['immich']['strength']
+    dither_mode = new_config['immich'].get('dither_mode', 'diffusion')
     display_mode = new_config['immich']['display_mode']
     image_order = new_config['immich']['image_order']
     sleep_start_hour = new_config['immich']['sleep_start_hour']
     sleep_end_hour = new_config['immich']['sleep_end_hour']
     sleep_start_minute = new_config['immich']['sleep_start_minute']
     sleep_end_minute = new_config['immich']['sleep_end_minute']
+    panel_name = new_config['immich'].get('panel', DEFAULT_PANEL)
+    photo_source = new_config['immich'].get('source', 'immich')
+    enabled_overlays = new_config['immich'].get('overlays') or []
     
-    print(f"Configuration updated: URL = {url}, Album = {albumname}, angle = {rotationAngle}, enhance = {img_enhanced}, contrast = {img_contrast}, strength = {strength}, display_mode = {display_mode}, image_order = {image_order}")
+    print(f"Configuration updated: URL = {url}, Album = {albumname}, angle = {rotationAngle}, enhance = {img_enhanced}, contrast = {img_contrast}, strength = {strength}, dither_mode = {dither_mode}, display_mode = {display_mode}, image_order = {image_order}, panel = {panel_name}, source = {photo_source}, overlays = {enabled_overlays}")
 
 def start_config_watcher(config_path):
     """ Start configuration file monitoring """
@@ -575,6 +569,15 @@ def settings():
     else:
         print("No battery information available")
 
+    def render_settings(error=None):
+        # Every branch passes the battery state, the template formats it
+        return render_template('settings.html',
+                               config=current_config,
+                               error=error,
+                               battery_voltage=battery_voltage,
+                               battery_percentage=battery_percentage,
+                               panels=PANEL_PROFILES.values())
+
     if request.method == 'POST':
         # Collect form data
         new_config = {
@@ -585,6 +588,7 @@ def settings():
                 'enhanced': float(request.form.get('enhanced', current_config['immich']['enhanced'])),
                 'contrast': float(request.form.get('contrast', current_config['immich']['contrast'])),
                 'strength': float(request.form.get('strength', current_config['immich']['strength'])),
+                'dither_mode': request.form.get('dither_mode', current_config['immich'].get('dither_mode', 'diffusion')),
                 'display_mode': request.form.get('display_mode', current_config['immich']['display_mode']),
                 'image_order': request.form.get('image_order', current_config['immich']['image_order']),
                 'sleep_start_hour': int(request.form.get('sleep_start_hour', current_config['immich']['sleep_start_hour'])),
@@ -592,14 +596,27 @@ def settings():
                 'sleep_end_hour': int(request.form.get('sleep_end_hour', current_config['immich']['sleep_end_hour'])),
                 'sleep_end_minute': int(request.form.get('sleep_end_minute', current_config['immich']['sleep_end_minute'])),
                 'wakeup_interval': int(request.form.get('wakeup_interval', current_config['immich']['wakeup_interval'])),
+                'panel': request.form.get('panel', current_config['immich'].get('panel', DEFAULT_PANEL)),
+                'source': request.form.get('source', current_config['immich'].get('source', 'immich')),
+                'overlays': [name for name in request.form.getlist('overlays') if name in OVERLAY_NAMES],
             }
         }
         
         # Validate rotation values
         if new_config['immich']['rotation'] not in [0, 90, 180, 270]:
-            return render_template('settings.html', 
-                                   config=current_config, 
-                                   error="Rotation must be 0, 90, 180, or 270 degrees")
+            return render_settings("Rotation must be 0, 90, 180, or 270 degrees")
+
+        # Validate panel profile
+        if new_config['immich']['panel'] not in PANEL_PROFILES:
+            return render_settings("Unknown panel profile")
+
+        # Validate dithering mode
+        if new_config['immich']['dither_mode'] not in DITHER_MODES:
+            return render_settings("Unknown dithering mode")
+
+        # Validate photo source
+        if new_config['immich']['source'] not in ['immich', 'local']:
+            return render_settings("Photo source must be immich or local")
         
         try:
             # Write to config file
@@ -612,14 +629,9 @@ def settings():
             return redirect(url_for('settings'))
         
         except Exception as e:
-            return render_template('settings.html', 
-                                   config=current_config, 
-                                   error=f"Error saving configuration: {str(e)}")
+            return render_settings(f"Error saving configuration: {str(e)}")
     
-    return render_template('settings.html', 
-                         config=current_config, 
-                         battery_voltage=battery_voltage,
-                         battery_percentage=battery_percentage)
+    return render_settings()
 
 @app.route('/')
 def index():
@@ -648,6 +660,24 @@ def run_daily_ntp_sync():
             print(f"Error in daily NTP sync: {e}")
             time.sleep(3600)  # Retry after 1 hour if error occurs
 
+def run_nightly_warmup():
+    """Nightly album warm-up task"""
+    while True:
+        try:
+            # Calculate next 3:00 AM, before the NTP sync
+            now = datetime.now()
+            next_run = now.replace(hour=3, minute=0, second=0, microsecond=0)
+            if now >= next_run:
+                next_run = next_run + timedelta(days=1)
+            time.sleep((next_run - now).total_seconds())
+
+            if not start_warmup('nightly'):
+                print("Nightly warm-up skipped, a warm-up is already running")
+
+        except Exception as e:
+            print(f"Error in nightly warm-up: {e}")
+            time.sleep(3600)  # Retry after 1 hour if error occurs
+
 def main():
     config_path = '/config/config.yaml'
     
@@ -659,10 +689,22 @@ def main():
         initial_config = ConfigFileHandler(config_path, update_app_config).config
         update_app_config(initial_config)
         
+        # Index the local photo directory before the first wake
+        if photo_source == 'local':
+            get_local_index()
+        
         # Start daily NTP sync thread
         ntp_sync_thread = threading.Thread(target=run_daily_ntp_sync, daemon=True)
         ntp_sync_thread.start()
         
+        # Last warm-up state, a job that died with the server is not restarted
+        warmup_job.recover()
+        
+        # Start nightly warm-up thread
+        if WARMUP_NIGHTLY:
+            warmup_thread = threading.Thread(target=run_nightly_warmup, daemon=True)
+            warmup_thread.start()
+        
         # Run Flask application in a separate thread
         app.run(host='0.0.0.0', port=5000, use_reloader=False)
     except KeyboardInterrupt:
@@ -690,109 +732,214 @@ def process_and_download():
     battery_voltage = request.headers.get('batteryCap', 'Unknown')
     # print(f"Battery: {battery_voltage} mV")
     
+    # Battery level and status shown by the overlays
     try:
-        # Check if url and albumname are valid
-        if not current_url or not current_albumname:
-            return jsonify({"error": "Immich URL or Album not configured"}), 500
-            
-        # Load list of downloaded images
-        downloaded_images = load_downloaded_images()
-            
-        # Get album list
-        response = requests.get(f"{current_url}/api/albums", headers=headers)
-        if response.status_code != 200:
-            return jsonify({"error": "Failed to fetch albums"}), 500
-        
-        # Find specified album
-        data = response.json()
-        albumid = next((item['id'] for item in data if item['albumName'] == current_albumname), None)
-        if not albumid:
-            return jsonify({"error": "Album not found"}), 404
+        reported_voltage = float(battery_voltage)
+    except ValueError:
+        reported_voltage = 0
+    battery_percentage = calculate_battery_percentage(reported_voltage) if reported_voltage > 0 else None
+    status = "Low battery" if battery_percentage is not None and battery_percentage <= LOW_BATTERY else None
 
-        # Get photos in the album
-        response = requests.get(f"{url}/api/albums/{albumid}", headers=headers)
-        if response.status_code != 200:
-            return jsonify({"error": "Failed to fetch album details"}), 500
-
-        data = response.json()
-        if 'assets' not in data or not data['assets']:
-            return jsonify({"error": "No images found in album"}), 404
+    # Devices announce their panel, older firmware uses the configured one
+    panel = get_panel(request.headers.get('panel') or panel_name)
+    seen_panels.add(panel.name)
+    
+    # Photo source of this wake, the setting may change while it is served
+    source = photo_source
+    
+    # Photo claimed by this device on an earlier request that got no frame
+    device = device_key()
+    claim = None
+    if device is not None:
+        with device_claims_lock:
+            claim = device_claims.get(device)
+    if claim is not None and claim[0] != source:
+        claim = None
 
+    # Whether the claim stays for the device's retry, e.g. after a 202
+    keep_claim = False
+    try:
         # Get display order setting
         image_order = current_config['immich']['image_order']
 
-        if image_order == 'newest':
-            # Check if new photos have been added
-            latest_photo = max(data['assets'], key=lambda x: x.get('exifInfo', {}).get('dateTimeOriginal', '1970-01-01T00:00:00'))
-            latest_id = latest_photo['id']
+        if claim is not None:
+            # Retry of an undelivered frame, show the photo claimed for it
+            _, albumid, selected_image = claim
+            asset_id = selected_image['id']
+        elif source == 'local':
+            # Pick from the local directory index, no Immich round trip
+            albumid = LOCAL_ALBUM_ID
+            selected_image = select_local_photo(image_order)
+            if selected_image is None:
+                return jsonify({"error": "No images found in local directory"}), 404
+            asset_id = selected_image['id']
+        else:
+            # Check if url and albumname are valid
+            if not current_url or not current_albumname:
+                return jsonify({"error": "Immich URL or Album not configured"}), 500
             
-            # Reset tracking file if it's empty or latest photo is not in downloaded list
-            downloaded_images = load_downloaded_images()
-            if not downloaded_images or latest_id not in downloaded_images:
-                reset_tracking_file()
-                # Sort photos by capture time
-                sorted_assets = sorted(data['assets'], 
-                                    key=lambda x: x.get('exifInfo', {}).get('dateTimeOriginal', '1970-01-01T00:00:00'),
-                                    reverse=True)
-                remaining_images = sorted_assets
-            else:
-                # Sort undownloaded photos by time
-                remaining_images = [img for img in data['assets'] if img['id'] not in downloaded_images]
-                remaining_images.sort(key=lambda x: x.get('exifInfo', {}).get('dateTimeOriginal', '1970-01-01T00:00:00'),
-                                   reverse=True)
-        else:  # random order
-            remaining_images = [img for img in data['assets'] if img['id'] not in downloaded_images]
-            if not remaining_images:
-                reset_tracking_file()
-                remaining_images = data['assets']
-
-        # Select photo
-        selected_image = remaining_images[0] if image_order == 'newest' else random.choice(remaining_images)
-        asset_id = selected_image['id']
-        
-        # Record downloaded image
-        save_downloaded_image(asset_id)
+            # Get album list
+            status_code, data = fetch_immich_json(f"{current_url}/api/albums")
+            if status_code != 200:
+                return jsonify({"error": "Failed to fetch albums"}), 500
 
-        # Download image to memory
-        response = requests.get(f"{url}/api/assets/{asset_id}/original", headers=headers, stream=True)
-        if response.status_code != 200:
-            return jsonify({"error": "Failed to download image"}), 500
+            # Find specified album, rotating between albums when several are configured
+            album_entries = parse_album_setting(current_albumname, [item['albumName'] for item in data])
+            if not album_entries:
+                return jsonify({"error": "Immich URL or Album not configured"}), 500
+            selected_album = selection_engine.pick_album(album_entries)
+            album = next((item for item in data if item['albumName'] == selected_album), None)
+            if not album:
+                return jsonify({"error": "Album not found"}), 404
+            albumid = album['id']
 
-        # Process image in memory
-        image_data = io.BytesIO(response.content)
-        
-        # Process image based on its type
-        if selected_image['originalPath'].lower().endswith(('.raw', '.dng', '.arw', '.cr2', '.nef')):
-            with rawpy.imread(image_data) as raw:
-                rgb = raw.postprocess(use_camera_wb=True, use_auto_wb=False)
-                image = Image.fromarray(rgb)
-        elif selected_image['originalPath'].lower().endswith('.heic'):
-            image = Image.open(image_data).convert("RGB")
-        else:
-            image = Image.open(image_data)
+            # Claim the next photo, the album is only fetched and diffed when it changed
+            selected_image = None
+            for attempt in range(2):
+                if selection_engine.needs_sync(albumid, album_fingerprint(album), image_order):
+                    # Get photos in the album
+                    status_code, album_details = fetch_immich_json(f"{current_url}/api/albums/{albumid}")
+                    if status_code != 200:
+                        return jsonify({"error": "Failed to fetch album details"}), 500
+                    selection_engine.sync(albumid, album_details.get('assets') or [], album_fingerprint(album), image_order)
+
+                # Concurrent wakes each claim their own photo
+                asset_id = selection_engine.advance(albumid)
+                if asset_id is None:
+                    return jsonify({"error": "No images found in album"}), 404
+                selected_image = selection_engine.asset(albumid, asset_id)
+                if selected_image is not None:
+                    break
+                # Order restored from disk, only this asset's details are needed
+                response = requests.get(f"{current_url}/api/assets/{asset_id}", headers=headers, timeout=IMMICH_TIMEOUT)
+                if response.status_code == 200:
+                    selected_image = response.json()
+                    break
+                # The asset is gone, resync the album and pick again
+                selection_engine.invalidate(albumid)
+            if selected_image is None:
+                return jsonify({"error": "Failed to fetch asset details"}), 500
 
-        # Process image
-        processed_image = scale_img_in_memory(image)
+        claim = (source, albumid, selected_image)
+        if device is not None:
+            with device_claims_lock:
+                device_claims[device] = claim
         
-        # Convert to C code
-        processed_image.seek(0)
-        c_code = convert_to_c_code_in_memory(Image.open(processed_image))
+        # Per-request part: this frame's captions and packing
+        def finish_frame(frame, buffers, stage):
+            # Captions go on the dithered frame so they stay crisp
+            with stage('overlay'):
+                draw_overlays(frame, panel, rotationAngle, enabled_overlays,
+                              date=(selected_image.get('exifInfo') or {}).get('dateTimeOriginal'),
+                              battery=battery_percentage, status=status)
+
+            # Convert to C code
+            with stage('pack'):
+                return convert_to_c_code_in_memory(frame, buffers, panel)
+
+        # Wakes that claimed the same photo (retries) share its render. Frame sized
+        # arrays come from the pool only once there is a frame to draw, requests
+        # waiting for a render or for the budget hold none
+        fingerprint = render_fingerprint(panel)
+        with render_flight.join((source, asset_id) + fingerprint) as (flight, leader):
+            if not leader:
+                try:
+                    shared_frame = flight.wait()
+                except TimeoutError:
+                    shared_frame = None
+                if shared_frame is None:
+                    keep_claim = True
+                    return jsonify({"error": "Photo still rendering, retry later"}), 202
+                with frame_buffers(panel.width, panel.height) as buffers:
+                    np.copyto(buffers.indices, shared_frame)
+                    c_code = finish_frame(buffers.indices, buffers, lambda name: contextlib.nullcontext())
+            else:
+                with frame_buffers(panel.width, panel.height) as buffers:
+                    stored = frame_store.load(fingerprint, source, stored_frame_id(selected_image),
+                                              buffers.indices) is not None
+                    if stored:
+                        # Rendered by an earlier wake or the warm-up job, only the overlays are drawn
+                        flight.resolve(buffers.indices.copy())
+                        c_code = finish_frame(buffers.indices, buffers, lambda name: contextlib.nullcontext())
+                if not stored:
+                    # Wait until the estimated peak memory of this render fits the budget
+                    with admitted_render(estimate_render_bytes(selected_image, panel.width * panel.height)) as profile:
+                        if profile is None:
+                            # Firmware retries on 202 and gets the same photo
+                            keep_claim = True
+                            return jsonify({"error": "Render memory budget exhausted, retry later"}), 202
+
+                        # Download image to memory
+                        with profile.stage('download'):
+                            if source == 'local':
+                                # Decoders read local files directly
+                                image_data = selected_image['originalPath']
+                            else:
+                                response = requests.get(f"{url}/api/assets/{asset_id}/original", headers=headers,
+                                                        stream=True, timeout=IMMICH_TIMEOUT)
+                                if response.status_code != 200:
+                                    raise RuntimeError("Failed to download image")
+
+                                # Process image in memory
+                                image_data = io.BytesIO(response.content)
+                                del response
+
+                        # Process image based on its type
+                        with profile.stage('decode'):
+                            image = decode_image(image_data, selected_image['originalPath'], panel)
+
+                        # Process image into pooled frame buffers, returned once the frame is packed
+                        with frame_buffers(panel.width, panel.height) as buffers:
+                            frame = render_frame(image, buffers, profile, panel)
+                            del image, image_data
+
+                            # Waiting requests get a copy, the buffers go back to the pool
+                            flight.resolve(frame.copy())
+                            frame_store.save(fingerprint, source, stored_frame_id(selected_image), frame)
+                            c_code = finish_frame(frame, buffers, profile.stage)
         
-        return send_file(
+        response = send_file(
             c_code,
             mimetype='text/plain',
             as_attachment=True,
             download_name=f"image_{asset_id}.c"
         )
+        # Lets frames skip refreshing a frame they already show
+        response.headers['X-Frame-Hash'] = hashlib.sha1(c_code.getbuffer()).hexdigest()[:16]
+        return response
 
     except Exception as e:
+        # A photo that fails is skipped, the next wake claims the following one
         return jsonify({"error": str(e)}), 500
 
-@app.route('/sleep', methods=['GET'])
-def get_sleep_duration():
-    # Use system time instead of NTP sync
-    current_time = datetime.now()
-    
+    finally:
+        if not keep_claim:
+            release_claim(device, claim)
+
+@app.route('/memory', methods=['GET'])
+def get_memory_status():
+    """ Render memory budget, peak memory per stage and coalesced requests """
+    status = memory_status()
+    status['single_flight'] = {'renders': render_flight.status(), 'album_fetches': album_flight.status(),
+                               'pending_claims': len(device_claims)}
+    status['frame_store'] = frame_store.status()
+    return jsonify(status)
+
+@app.route('/warmup', methods=['GET', 'POST'])
+def warmup():
+    """ Start the album warm-up (POST) or report its progress (GET) """
+    if request.method == 'POST':
+        if request.form.get('action') == 'stop' or (request.get_json(silent=True) or {}).get('action') == 'stop':
+            warmup_job.stop()
+        elif not start_warmup():
+            return jsonify({"error": "Warm-up already running", **warmup_job.status()}), 409
+        return jsonify(warmup_job.status()), 202
+    status = warmup_job.status()
+    status['store'] = frame_store.status()
+    return jsonify(status)
+
+def calculate_sleep(current_time):
+    """ Next wake time and sleep duration in milliseconds, skipping the sleep period """
     # Get wake interval from config (in minutes)
     interval = int(current_config['immich']['wakeup_interval'])
     
@@ -858,15 +1005,52 @@ def get_sleep_duration():
             next_wakeup = sleep_end
         sleep_ms = int((next_wakeup - current_time).total_seconds() * 1000)
     
+    return next_wakeup, sleep_ms
+
+@app.route('/sleep', methods=['GET'])
+def get_sleep_duration():
+    # Use system time instead of NTP sync
+    current_time = datetime.now()
+    next_wakeup, sleep_ms = calculate_sleep(current_time)
+    
     return jsonify({
         "current_time": current_time.strftime("%Y-%m-%d %H:%M:%S"),
         "next_wakeup": next_wakeup.strftime("%Y-%m-%d %H:%M:%S"),
         "sleep_duration": sleep_ms
     })
 
+@app.route('/frame', methods=['GET'])
+def get_frame():
+    """
+    Frame and wake schedule in a single round trip
+
+    Same body and status codes as /download, the schedule and device commands
+    travel in response headers so the frame needs no second request to /sleep:
+    X-Sleep-Duration (ms), X-Next-Wakeup, X-Frame-Hash and X-Commands. Errors
+    carry the schedule too. When the frame sends the hash of the frame it shows
+    in If-None-Match and nothing changed, the answer is 304 without a body and
+    the "skip" command.
+    """
+    response = make_response(process_and_download())
+    next_wakeup, sleep_ms = calculate_sleep(datetime.now())
+
+    commands = []
+    frame_hash = response.headers.get('X-Frame-Hash')
+    if response.status_code == 200 and frame_hash and frame_hash == request.headers.get('If-None-Match'):
+        response = make_response('', 304)
+        response.headers['X-Frame-Hash'] = frame_hash
+        commands.append('skip')
+
+    response.headers['X-Sleep-Duration'] = str(sleep_ms)
+    response.headers['X-Next-Wakeup'] = next_wakeup.strftime("%Y-%m-%d %H:%M:%S")
+    response.headers['X-Commands'] = ','.join(commands)
+    return response
+
+
 def sync_time_with_ntp():
     """Sync time with NTP server"""
     try:
+        import ntplib
         ntp_client = ntplib.NTPClient()
         response = ntp_client.request('pool.ntp.org', timeout=5)
         return datetime.fromtimestamp(response.tx_time)
@@ -4,6 +4,7 @@
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel cimport prange
 
 from libc.math cimport pow
 #import time
@@ -14,6 +15,10 @@ from libc.stdint cimport uint16_t, uint32_t
 EPD_W = 800
 EPD_H = 480
 
+# Version of the kernel signatures, bumped whenever one changes so a compiled
+# module built from older sources is detected instead of failing mid-request
+ENGINE_API = 4
+
 ctypedef np.float32_t FLOAT_TYPE
 ctypedef np.uint8_t UINT8_TYPE
 
@@ -57,11 +62,12 @@ cdef double gamma_linear(double inp) nogil:
         return pow((inp + 0.055) / (1.0 + 0.055), 2.4)
     return inp / 12.92
 
-def load_scaled(image, angle, display_mode='fit'):
+def load_scaled(image, angle, display_mode='fit', width=EPD_W, height=EPD_H):
     if isinstance(image, str):
         img = Image.open(image)
     else:
-        img = image.copy()
+        # convert() below already returns a new image, no need for copy()
+        img = image
 
     img = img.convert('RGB')
     img = img.rotate(angle, expand=True)
@@ -70,129 +76,272 @@ def load_scaled(image, angle, display_mode='fit'):
     if display_mode == 'fill':
         # 填滿螢幕模式：將圖像裁剪並縮放以填滿整個螢幕
         orig_ratio = img.width / img.height
-        epd_ratio = EPD_W / EPD_H
+        epd_ratio = width / height
         
         if orig_ratio > epd_ratio:
             # 圖像太寬，需要裁剪兩側
-            new_height = EPD_H
+            new_height = height
             new_width = int(new_height * orig_ratio)
             img = img.resize((new_width, new_height), Image.LANCZOS)
-            left = (new_width - EPD_W) // 2
-            img = img.crop((left, 0, left + EPD_W, EPD_H))
+            left = (new_width - width) // 2
+            img = img.crop((left, 0, left + width, height))
         else:
             # 圖像太高，需要裁剪上下
-            new_width = EPD_W
+            new_width = width
             new_height = int(new_width / orig_ratio)
             img = img.resize((new_width, new_height), Image.LANCZOS)
-            top = (new_height - EPD_H) // 2
-            img = img.crop((0, top, EPD_W, top + EPD_H))
+            top = (new_height - height) // 2
+            img = img.crop((0, top, width, top + height))
     else:
         # 原有的符合螢幕寬度模式
         orig_ratio = img.width / img.height
-        epd_ratio = EPD_W / EPD_H
+        epd_ratio = width / height
         
         if orig_ratio > epd_ratio:
-            new_width = EPD_W
+            new_width = width
             new_height = int(new_width / orig_ratio)
         else:
-            new_height = EPD_H
+            new_height = height
             new_width = int(new_height * orig_ratio)
         
         img = img.resize((new_width, new_height), Image.LANCZOS)
         
-        bg = Image.new('RGB', (EPD_W, EPD_H), (255, 255, 255))
-        offset = ((EPD_W - new_width) // 2, (EPD_H - new_height) // 2)
+        bg = Image.new('RGB', (width, height), (255, 255, 255))
+        offset = ((width - new_width) // 2, (height - new_height) // 2)
         bg.paste(img, offset)
         return bg
     
     return img
 
-def convert_image(input_image, preview_path=None, dithering_strength=1.0):
-    """Cython-optimized image conversion function."""
-    # Prepare input data
-    cdef np.ndarray[np.uint8_t, ndim=3] img_array = np.array(input_image, dtype=np.uint8)
-    
-    cdef double[:, :] epd_colors = np.array([
-        [0, 0, 0], # Black
-        [1, 1, 1], # White
-        [0, 1, 0], # Green
-        [0, 0, 1], # Blue
-        [1, 0, 0], # Red
-        [1, 1, 0], # Yellow
-        [1, 0.647, 0], # Orange
-    ], dtype=np.float64)
-    
-    # Prepare output arrays
-    cdef np.ndarray[np.uint8_t, ndim=3] pixels = np.zeros((EPD_H, EPD_W, 3), dtype=np.uint8)
-    cdef np.ndarray[np.uint8_t, ndim=3] output_img = np.zeros((EPD_H, EPD_W, 3), dtype=np.uint8)
+# ACeP 7-color palette of the 7.3inch e-Paper (F), used when no palette is given
+EPD_COLORS = np.array([
+    [0, 0, 0], # Black
+    [1, 1, 1], # White
+    [0, 1, 0], # Green
+    [0, 0, 1], # Blue
+    [1, 0, 0], # Red
+    [1, 1, 0], # Yellow
+    [1, 0.647, 0], # Orange
+], dtype=np.float64)
 
-    # Copy and convert input image
-    cdef int x, y, c, best, ob
-    cdef double diff, min_diff
-    
-    for y in range(EPD_H):
-        for x in range(EPD_W):
-            # Convert pixel
-            #for c in range(3):
-            #    pixels[y, x, c] = <np.uint8_t>(gamma_linear(img_array[y, x, c] / 255.0) * 255)
-            for c in range(3):
-                pixels[y, x, c] = img_array[y, x, c]
+cdef inline UINT8_TYPE clamp_u8(int v) noexcept nogil:
+    if v < 0:
+        return 0
+    if v > 255:
+        return 255
+    return <UINT8_TYPE>v
 
-    # Color quantization with Floyd-Steinberg dithering
-    ob = 0
-    for y in range(EPD_H):
-        for x in range(EPD_W):
+@cython.cdivision(True)
+cdef void dither_fs(UINT8_TYPE[:, :, ::1] pixels, const double[:, ::1] colors,
+                    UINT8_TYPE[:, ::1] indices, double strength) noexcept nogil:
+    """
+    Floyd-Steinberg dithering to palette indices
+
+    The palette is plain data, so every panel profile runs the same tight
+    loop without branching on the profile per pixel.
+    """
+    cdef Py_ssize_t height = pixels.shape[0]
+    cdef Py_ssize_t width = pixels.shape[1]
+    cdef Py_ssize_t ncolors = colors.shape[0]
+    cdef Py_ssize_t x, y, c, i
+    cdef int best
+    cdef double d, diff, min_diff, scaled_diff
+
+    for y in range(height):
+        for x in range(width):
             # Find closest EPD color
             min_diff = 1e10
             best = 0
-            for c in range(epd_colors.shape[0]):
+            for c in range(ncolors):
                 diff = 0
                 for i in range(3):
-                    diff += (pixels[y, x, i] / 255.0 - epd_colors[c, i]) ** 2
+                    d = pixels[y, x, i] / 255.0 - colors[c, i]
+                    diff += d * d
                 if diff < min_diff:
                     min_diff = diff
                     best = c
-
-    # Color quantization with Floyd-Steinberg dithering and improved color matching
-    #for y in range(EPD_H):
-    #    for x in range(EPD_W):
-    #        # Find closest EPD color using weighted distance
-    #        best = closestColor(
-    #            <uint16_t>pixels[y, x, 0], 
-    #            <uint16_t>pixels[y, x, 1], 
-    #            <uint16_t>pixels[y, x, 2], 
-    #            epd_colors
-    #        )
+            indices[y, x] = best
 
             # Floyd-Steinberg error distribution with strength control
-            dithering_strength = dithering_strength  # New parameter to control error diffusion (0.0 to 1.0)
-
             for c in range(3):
-                diff = (pixels[y, x, c] / 255.0 - epd_colors[best, c])
-                
+                diff = (pixels[y, x, c] / 255.0 - colors[best, c])
+
                 # Scale the diff by dithering_strength
-                scaled_diff = diff * dithering_strength
-                
+                scaled_diff = diff * strength
+
                 # Right pixel
-                if x+1 < EPD_W:
-                    pixels[y, x+1, c] = <np.uint8_t>(min(max(pixels[y, x+1, c] + <int>(scaled_diff * 7/16 * 255), 0), 255))
-                
+                if x+1 < width:
+                    pixels[y, x+1, c] = clamp_u8(pixels[y, x+1, c] + <int>(scaled_diff * 7/16 * 255))
+
                 # Bottom-left pixel
-                if x-1 >= 0 and y+1 < EPD_H:
-                    pixels[y+1, x-1, c] = <np.uint8_t>(min(max(pixels[y+1, x-1, c] + <int>(scaled_diff * 3/16 * 255), 0), 255))
-                
+                if x-1 >= 0 and y+1 < height:
+                    pixels[y+1, x-1, c] = clamp_u8(pixels[y+1, x-1, c] + <int>(scaled_diff * 3/16 * 255))
+
                 # Bottom pixel
-                if y+1 < EPD_H:
-                    pixels[y+1, x, c] = <np.uint8_t>(min(max(pixels[y+1, x, c] + <int>(scaled_diff * 5/16 * 255), 0), 255))
-                
+                if y+1 < height:
+                    pixels[y+1, x, c] = clamp_u8(pixels[y+1, x, c] + <int>(scaled_diff * 5/16 * 255))
+
                 # Bottom-right pixel
-                if x+1 < EPD_W and y+1 < EPD_H:
-                    pixels[y+1, x+1, c] = <np.uint8_t>(min(max(pixels[y+1, x+1, c] + <int>(scaled_diff * 1/16 * 255), 0), 255))
+                if x+1 < width and y+1 < height:
+                    pixels[y+1, x+1, c] = clamp_u8(pixels[y+1, x+1, c] + <int>(scaled_diff * 1/16 * 255))
 
-            # Set output image pixel
-            for c in range(3):
-                output_img[y, x, c] = <np.uint8_t>(epd_colors[best, c] * 255)
+cdef void dither_threshold(const UINT8_TYPE[:, :, :] pixels, const UINT8_TYPE[:, :, ::1] lut,
+                           const short[:, ::1] offsets, UINT8_TYPE[:, ::1] indices,
+                           int shift) noexcept nogil:
+    """
+    Ordered dithering to palette indices
+
+    Every pixel only depends on its own value and position, so rows are
+    spread across cores.
+    """
+    cdef Py_ssize_t height = pixels.shape[0]
+    cdef Py_ssize_t width = pixels.shape[1]
+    cdef Py_ssize_t tile_h = offsets.shape[0]
+    cdef Py_ssize_t tile_w = offsets.shape[1]
+    cdef Py_ssize_t x, y, ty, tx
+    cdef int o
+
+    for y in prange(height, schedule='static'):
+        ty = y % tile_h
+        tx = 0
+        for x in range(width):
+            o = offsets[ty, tx]
+            indices[y, x] = lut[clamp_u8(pixels[y, x, 0] + o) >> shift,
+                                clamp_u8(pixels[y, x, 1] + o) >> shift,
+                                clamp_u8(pixels[y, x, 2] + o) >> shift]
+            # Wrap around the tile without a division per pixel
+            tx = tx + 1
+            if tx == tile_w:
+                tx = 0
+
+cdef void pack_4bpp(const UINT8_TYPE[:, :] indices, const UINT8_TYPE[::1] codes,
+                    UINT8_TYPE[::1] out) noexcept nogil:
+    """Two pixels per byte, first pixel in the high nibble."""
+    cdef Py_ssize_t height = indices.shape[0]
+    cdef Py_ssize_t width = indices.shape[1]
+    cdef Py_ssize_t pairs = width // 2
+    cdef Py_ssize_t row_bytes = (width + 1) // 2
+    cdef Py_ssize_t x, y, o
+
+    for y in range(height):
+        o = y * row_bytes
+        for x in range(pairs):
+            out[o + x] = (codes[indices[y, 2*x]] << 4) | codes[indices[y, 2*x+1]]
+        if width & 1:
+            out[o + pairs] = codes[indices[y, width-1]] << 4
+
+cdef void pack_2bpp(const UINT8_TYPE[:, :] indices, const UINT8_TYPE[::1] codes,
+                    UINT8_TYPE[::1] out) noexcept nogil:
+    """Four pixels per byte, first pixel in the two highest bits."""
+    cdef Py_ssize_t height = indices.shape[0]
+    cdef Py_ssize_t width = indices.shape[1]
+    cdef Py_ssize_t quads = width // 4
+    cdef Py_ssize_t row_bytes = (width + 3) // 4
+    cdef Py_ssize_t x, y, o, k
+    cdef UINT8_TYPE b
+
+    for y in range(height):
+        o = y * row_bytes
+        for x in range(quads):
+            out[o + x] = ((codes[indices[y, 4*x]] << 6) | (codes[indices[y, 4*x+1]] << 4)
+                          | (codes[indices[y, 4*x+2]] << 2) | codes[indices[y, 4*x+3]])
+        if width & 3:
+            b = 0
+            for k in range(width & 3):
+                b |= codes[indices[y, 4*quads+k]] << (6 - 2*k)
+            out[o + quads] = b
+
+def dither_indices(input_image, palette=None, dithering_strength=1.0, out=None, work=None):
+    """Dither an RGB image to palette indices.
+
+    :param palette: (N, 3) colors in 0..1, EPD_COLORS when omitted
+    :param out: optional preallocated (H, W) uint8 array for the indices
+    :param work: optional preallocated (H, W, 3) uint8 scratch buffer
+    :return: (H, W) uint8 array of palette indices
+    """
+    src = np.asarray(input_image, dtype=np.uint8)
+    height, width = src.shape[0], src.shape[1]
+    colors = EPD_COLORS if palette is None else np.ascontiguousarray(palette, dtype=np.float64)
+    if work is None:
+        work = np.empty((height, width, 3), dtype=np.uint8)
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint8)
+
+    # Copy the input straight into the scratch buffer, no intermediate array
+    work[:, :, :] = src[:, :, :3]
+    cdef UINT8_TYPE[:, :, ::1] pixels = work
+    cdef const double[:, ::1] epd_colors = colors
+    cdef UINT8_TYPE[:, ::1] indices = out
+    cdef double strength = dithering_strength
+    with nogil:
+        dither_fs(pixels, epd_colors, indices, strength)
+    return out
+
+def dither_ordered(input_image, lut, offsets, out=None):
+    """Ordered dithering to palette indices, every pixel independent.
+
+    :param lut: (S, S, S) uint8 palette index of every RGB value >> (8 - log2(S))
+    :param offsets: (h, w) int16 threshold offsets, tiled over the image
+    :param out: optional preallocated (H, W) uint8 array for the indices
+    :return: (H, W) uint8 array of palette indices
+    """
+    src = np.asarray(input_image, dtype=np.uint8)
+    height, width = src.shape[0], src.shape[1]
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint8)
+    cdef const UINT8_TYPE[:, :, :] pixels = src
+    cdef const UINT8_TYPE[:, :, ::1] lut_view = np.ascontiguousarray(lut, dtype=np.uint8)
+    cdef const short[:, ::1] offset_view = np.ascontiguousarray(offsets, dtype=np.int16)
+    cdef UINT8_TYPE[:, ::1] indices = out
+    cdef int shift = 8 - (lut.shape[0].bit_length() - 1)
+    with nogil:
+        dither_threshold(pixels, lut_view, offset_view, indices, shift)
+    return out
+
+def pack_indices(indices, codes, int bits_per_pixel, out=None):
+    """Pack palette indices into panel bytes, rows padded to whole bytes.
+
+    :param indices: (H, W) uint8 palette indices
+    :param codes: panel color code of every palette index
+    :param bits_per_pixel: 4 or 2, selects the specialized kernel
+    :param out: optional flat uint8 buffer, at least as large as the result
+    :return: flat uint8 array of packed bytes
+    """
+    height, width = indices.shape[0], indices.shape[1]
+    pixels_per_byte = 8 // bits_per_pixel
+    nbytes = height * ((width + pixels_per_byte - 1) // pixels_per_byte)
+    if out is None:
+        out = np.empty(nbytes, dtype=np.uint8)
+    out = out[:nbytes]
+    cdef const UINT8_TYPE[:, :] idx = indices
+    cdef const UINT8_TYPE[::1] code_view = np.ascontiguousarray(codes, dtype=np.uint8)
+    cdef UINT8_TYPE[::1] packed = out
+    if bits_per_pixel == 4:
+        with nogil:
+            pack_4bpp(idx, code_view, packed)
+    elif bits_per_pixel == 2:
+        with nogil:
+            pack_2bpp(idx, code_view, packed)
+    else:
+        raise ValueError(f"Unsupported bits per pixel: {bits_per_pixel}")
+    return out
+
+def convert_image(input_image, preview_path=None, dithering_strength=1.0, out=None, work=None, palette=None):
+    """Cython-optimized image conversion function.
+
+    `out` and `work` are optional preallocated (H, W, 3) uint8 arrays for the
+    result and the dithering scratch buffer, so callers can reuse them across
+    calls instead of allocating new frames every time.
+    """
+    colors = EPD_COLORS if palette is None else np.asarray(palette, dtype=np.float64)
+    indices = dither_indices(input_image, colors, dithering_strength, work=work)
+
+    # Set output image pixels
+    rgb = (colors * 255).astype(np.uint8)
+    if out is None:
+        out = np.empty(indices.shape + (3,), dtype=np.uint8)
+    np.take(rgb, indices, axis=0, out=out)
 
     # Optional file outputs
 
-    return output_img
\ No newline at end of file
+    return out
@@ -0,0 +1,201 @@
+#-*- coding:utf8 -*-
+"""
+Pure NumPy implementation of the cpy extension
+
+Used when the compiled cpy module cannot be loaded (e.g. on an architecture
+it was not built for). Every function gives the same output as its cpy
+counterpart, only slower.
+
+Floyd-Steinberg error diffusion is sequential along a row, but pixel (y, x)
+only depends on pixels processed at x + 2y - 1 or earlier, so all pixels on
+the line x + 2y = t are independent and are dithered together as one vector.
+"""
+import numpy as np
+from PIL import Image
+
+# Constants
+EPD_W = 800
+EPD_H = 480
+
+# Version of the kernel signatures, bumped whenever one changes so a compiled
+# module built from older sources is detected instead of failing mid-request
+ENGINE_API = 4
+
+# ACeP 7-color palette of the 7.3inch e-Paper (F), used when no palette is given
+EPD_COLORS = np.array([
+    [0, 0, 0], # Black
+    [1, 1, 1], # White
+    [0, 1, 0], # Green
+    [0, 0, 1], # Blue
+    [1, 0, 0], # Red
+    [1, 1, 0], # Yellow
+    [1, 0.647, 0], # Orange
+], dtype=np.float64)
+
+
+def load_scaled(image, angle, display_mode='fit', width=EPD_W, height=EPD_H):
+    if isinstance(image, str):
+        img = Image.open(image)
+    else:
+        # convert() below already returns a new image, no need for copy()
+        img = image
+
+    img = img.convert('RGB')
+    img = img.rotate(angle, expand=True)
+
+    orig_ratio = img.width / img.height
+    epd_ratio = width / height
+
+    if display_mode == 'fill':
+        # Fill the screen: scale and crop the image to cover the whole panel
+        if orig_ratio > epd_ratio:
+            # Image too wide, crop both sides
+            new_height = height
+            new_width = int(new_height * orig_ratio)
+            img = img.resize((new_width, new_height), Image.LANCZOS)
+            left = (new_width - width) // 2
+            img = img.crop((left, 0, left + width, height))
+        else:
+            # Image too tall, crop top and bottom
+            new_width = width
+            new_height = int(new_width / orig_ratio)
+            img = img.resize((new_width, new_height), Image.LANCZOS)
+            top = (new_height - height) // 2
+            img = img.crop((0, top, width, top + height))
+        return img
+
+    # Fit the screen: scale the image inside the panel on a white background
+    if orig_ratio > epd_ratio:
+        new_width = width
+        new_height = int(new_width / orig_ratio)
+    else:
+        new_height = height
+        new_width = int(new_height * orig_ratio)
+
+    img = img.resize((new_width, new_height), Image.LANCZOS)
+
+    bg = Image.new('RGB', (width, height), (255, 255, 255))
+    offset = ((width - new_width) // 2, (height - new_height) // 2)
+    bg.paste(img, offset)
+    return bg
+
+
+def _diffuse(pixels, ys, xs, scaled_diff, numerator):
+    """ Add numerator/16 of the error to the given pixels, clamped like the C code """
+    delta = (scaled_diff * numerator / 16 * 255).astype(np.int32)
+    pixels[ys, xs] = np.clip(pixels[ys, xs] + delta, 0, 255)
+
+
+def dither_indices(input_image, palette=None, dithering_strength=1.0, out=None, work=None):
+    """Dither an RGB image to palette indices.
+
+    :param palette: (N, 3) colors in 0..1, EPD_COLORS when omitted
+    :param out: optional preallocated (H, W) uint8 array for the indices
+    :param work: unused, kept for signature compatibility with cpy
+    :return: (H, W) uint8 array of palette indices
+    """
+    src = np.asarray(input_image, dtype=np.uint8)
+    height, width = src.shape[0], src.shape[1]
+    colors = EPD_COLORS if palette is None else np.ascontiguousarray(palette, dtype=np.float64)
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint8)
+    pixels = src[:, :, :3].astype(np.int32)
+
+    for t in range(width + 2 * (height - 1)):
+        # Pixels on the line x + 2y = t
+        y_first = max(0, (t - width + 2) // 2)
+        y_last = min(height - 1, t // 2)
+        if y_first > y_last:
+            continue
+        ys = np.arange(y_first, y_last + 1)
+        xs = t - 2 * ys
+
+        # Find closest EPD color, summing channels in the same order as the C code
+        values = pixels[ys, xs] / 255.0
+        d = values[:, None, :] - colors[None, :, :]
+        d = d * d
+        best = np.argmin(d[:, :, 0] + d[:, :, 1] + d[:, :, 2], axis=1)
+        out[ys, xs] = best
+
+        # Floyd-Steinberg error distribution with strength control
+        scaled_diff = (values - colors[best]) * dithering_strength
+
+        # A pixel receives the bottom-left share from the row above before
+        # the right share from its left neighbour, both in this step
+        m = (xs >= 1) & (ys + 1 < height)
+        _diffuse(pixels, ys[m] + 1, xs[m] - 1, scaled_diff[m], 3)
+        m = xs + 1 < width
+        _diffuse(pixels, ys[m], xs[m] + 1, scaled_diff[m], 7)
+        m = ys + 1 < height
+        _diffuse(pixels, ys[m] + 1, xs[m], scaled_diff[m], 5)
+        m = (xs + 1 < width) & (ys + 1 < height)
+        _diffuse(pixels, ys[m] + 1, xs[m] + 1, scaled_diff[m], 1)
+
+    return out
+
+
+def dither_ordered(input_image, lut, offsets, out=None):
+    """Ordered dithering to palette indices, every pixel independent.
+
+    :param lut: (S, S, S) uint8 palette index of every RGB value >> (8 - log2(S))
+    :param offsets: (h, w) int16 threshold offsets, tiled over the image
+    :param out: optional preallocated (H, W) uint8 array for the indices
+    :return: (H, W) uint8 array of palette indices
+    """
+    src = np.asarray(input_image, dtype=np.uint8)
+    height, width = src.shape[0], src.shape[1]
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint8)
+    shift = 8 - (lut.shape[0].bit_length() - 1)
+    tile_h, tile_w = offsets.shape
+    tiled = np.tile(offsets, (-(-height // tile_h), -(-width // tile_w)))[:height, :width]
+
+    values = src[:, :, :3].astype(np.int16)
+    values += tiled[:, :, None]
+    np.clip(values, 0, 255, out=values)
+    values >>= shift
+    out[...] = lut[values[:, :, 0], values[:, :, 1], values[:, :, 2]]
+    return out
+
+
+def pack_indices(indices, codes, bits_per_pixel, out=None):
+    """Pack palette indices into panel bytes, rows padded to whole bytes.
+
+    :param indices: (H, W) uint8 palette indices
+    :param codes: panel color code of every palette index
+    :param bits_per_pixel: 4 or 2
+    :param out: optional flat uint8 buffer, at least as large as the result
+    :return: flat uint8 array of packed bytes
+    """
+    if bits_per_pixel not in (2, 4):
+        raise ValueError(f"Unsupported bits per pixel: {bits_per_pixel}")
+    height, width = indices.shape[0], indices.shape[1]
+    pixels_per_byte = 8 // bits_per_pixel
+    row_bytes = (width + pixels_per_byte - 1) // pixels_per_byte
+    nbytes = height * row_bytes
+    if out is None:
+        out = np.empty(nbytes, dtype=np.uint8)
+    out = out[:nbytes]
+
+    # Pad rows with code 0 up to whole bytes, first pixel in the highest bits
+    coded = np.zeros((height, row_bytes * pixels_per_byte), dtype=np.uint8)
+    coded[:, :width] = np.asarray(codes, dtype=np.uint8)[indices]
+    coded = coded.reshape(height, row_bytes, pixels_per_byte)
+    packed = out.reshape(height, row_bytes)
+    packed[:] = 0
+    for k in range(pixels_per_byte):
+        packed |= coded[:, :, k] << (8 - bits_per_pixel * (k + 1))
+    return out
+
+
+def convert_image(input_image, preview_path=None, dithering_strength=1.0, out=None, work=None, palette=None):
+    """NumPy image conversion function, same output as cpy.convert_image."""
+    colors = EPD_COLORS if palette is None else np.asarray(palette, dtype=np.float64)
+    indices = dither_indices(input_image, colors, dithering_strength, work=work)
+
+    # Set output image pixels
+    rgb = (colors * 255).astype(np.uint8)
+    if out is None:
+        out = np.empty(indices.shape + (3,), dtype=np.uint8)
+    np.take(rgb, indices, axis=0, out=out)
+    return out
@@ -0,0 +1,73 @@
+#-*- coding:utf8 -*-
+"""
+Image engine selection
+
+The compiled cpy extension is used when it loads. When it is missing or was
+built for another Python/architecture, the pure NumPy implementation in
+cpy_numpy is used instead; both give identical output. A compiled module
+whose ENGINE_API differs from the sources is stale and is not used, and a
+small probe image must dither and pack to the same bytes in both engines.
+Set RENDER_ENGINE=numpy to force the fallback.
+"""
+import os
+import warnings
+
+ENGINE = 'numpy'
+
+
+def _probe_kernels():
+    """
+    Dither and pack a small fixed image with both engines
+
+    Raises ImportError when the compiled kernels give other bytes than the
+    NumPy ones, e.g. a module built from other sources or compiler flags.
+    """
+    import numpy as np
+    from PIL import Image
+
+    import cpy
+    import cpy_numpy
+
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (8, 16, 3), dtype=np.uint8), 'RGB')
+    codes = np.array([0, 1, 2, 3, 5, 6, 4], dtype=np.uint8)
+    indices = cpy_numpy.dither_indices(image, None, 0.8)
+    if not np.array_equal(cpy.dither_indices(image, None, 0.8), indices):
+        raise ImportError("dither_indices output differs from the NumPy engine")
+    for bits_per_pixel in (4, 2):
+        probe = indices % (1 << bits_per_pixel)
+        if not np.array_equal(cpy.pack_indices(probe, codes, bits_per_pixel),
+                              cpy_numpy.pack_indices(probe, codes, bits_per_pixel)):
+            raise ImportError(f"pack_indices output differs from the NumPy engine ({bits_per_pixel} bpp)")
+
+if os.getenv('RENDER_ENGINE', 'auto') != 'numpy':
+    try:
+        # Cython and NumPy report ABI mismatches as RuntimeWarning, and
+        # importing such a module anyway can crash the interpreter
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            import cpy
+            from cpy_numpy import ENGINE_API
+            # Modules built from older sources lack newer kernels or arguments
+            if getattr(cpy, 'ENGINE_API', None) != ENGINE_API:
+                raise ImportError(f"built for engine API {getattr(cpy, 'ENGINE_API', 'unknown')}, "
+                                  f"expected {ENGINE_API}, rebuild with setup.py")
+            from cpy import (EPD_H, EPD_W, convert_image, dither_indices, dither_ordered, load_scaled,
+                             pack_indices)
+        ENGINE = 'cython'
+        _probe_kernels()
+    except ModuleNotFoundError as e:
+        if e.name != 'cpy':
+            raise
+        print("Cython extension cpy not built, using NumPy engine")
+    except (ImportError, RuntimeWarning) as e:
+        # A module that exists but won't load (missing libgomp1, other Python, stale sources)
+        # silently costs a lot of speed, so make it stand out
+        print(f"WARNING: Cython extension cpy exists but is not usable ({e}), "
+              f"using the slower NumPy engine")
+
+if ENGINE == 'numpy':
+    from cpy_numpy import (EPD_H, EPD_W, convert_image, dither_indices, dither_ordered, load_scaled,
+                           pack_indices)
+
+print(f"Image engine: {ENGINE}")
@@ -0,0 +1,265 @@
+#-*- coding:utf8 -*-
+"""
+Persistent store of dithered frames
+
+Frames are stored as palette indices before overlays and packing, one file
+per photo under a directory per render fingerprint (panel and render
+settings). A wake for a stored photo skips download, decode and dithering and
+only draws its own overlays. Changing a render setting changes the
+fingerprint, so stale frames are never served.
+
+Panels have at most 16 colors, so two indices are packed per byte.
+
+The store stays bounded: a new render fingerprint replaces the directories
+of the panel's older settings, the warm-up removes the frames of photos that
+left the album, and past FRAME_STORE_MAX_MB the least recently used frames
+are evicted (loading a frame refreshes its modification time).
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+# Disk space (MB) of the stored frames, 0 for no limit
+MAX_STORE_MB = int(os.getenv('FRAME_STORE_MAX_MB', '2048'))
+# Eviction frees a bit more than needed so it does not run on every save
+EVICT_TO = 0.9
+
+
+def fingerprint_key(fingerprint):
+    """ Directory name of a render fingerprint """
+    return hashlib.sha1(repr(tuple(fingerprint)).encode()).hexdigest()[:16]
+
+
+def pack_nibbles(indices):
+    """ (H, W) indices below 16 to (H, W/2) bytes, W must be even """
+    return (indices[:, 0::2] << 4) | indices[:, 1::2]
+
+
+def unpack_nibbles(packed, out):
+    """ Inverse of pack_nibbles() into a preallocated (H, W) uint8 array """
+    np.right_shift(packed, 4, out=out[:, 0::2])
+    np.bitwise_and(packed, 0x0F, out=out[:, 1::2])
+    return out
+
+
+class FrameStore:
+    """ Dithered frames on disk, keyed by render fingerprint, source and asset ID """
+    def __init__(self, root, max_bytes=MAX_STORE_MB * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Stored frames and their bytes, counted on the first status() and kept
+        # up to date by save() and prune() instead of walking the store on every poll
+        self.lock = threading.Lock()
+        self.frames = None
+        self.size = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _dir(self, fingerprint):
+        return os.path.join(self.root, fingerprint_key(fingerprint))
+
+    def path(self, fingerprint, source, asset_id):
+        return os.path.join(self._dir(fingerprint), f"{source}-{asset_id}.npy")
+
+    def contains(self, fingerprint, source, asset_id):
+        return os.path.exists(self.path(fingerprint, source, asset_id))
+
+    def load(self, fingerprint, source, asset_id, out):
+        """
+        Read a stored frame into out
+
+        :param out: (panel.height, panel.width) uint8 array
+        :return: out, or None when the frame is not stored
+        """
+        path = self.path(fingerprint, source, asset_id)
+        try:
+            stored = np.load(path, allow_pickle=False)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            print(f"Error reading stored frame {path}: {e}")
+            self.misses += 1
+            return None
+        if stored.shape == out.shape:
+            np.copyto(out, stored)
+        elif stored.shape == (out.shape[0], out.shape[1] // 2):
+            unpack_nibbles(stored, out)
+        else:
+            print(f"Stored frame {path} has shape {stored.shape}, expected {out.shape}")
+            self.misses += 1
+            return None
+        try:
+            # Recently used frames are evicted last
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return out
+
+    def save(self, fingerprint, source, asset_id, indices):
+        """ Store a frame atomically, an interrupted write never leaves a partial frame """
+        directory = self._dir(fingerprint)
+        manifest = os.path.join(directory, 'fingerprint.json')
+        if not os.path.exists(manifest):
+            os.makedirs(directory, exist_ok=True)
+            self._write(manifest, json.dumps(list(fingerprint)).encode())
+            # Settings changed, the panel's frames of the old ones are never served again
+            self.prune([fingerprint])
+        if indices.shape[1] % 2 == 0 and int(indices.max(initial=0)) < 16:
+            indices = pack_nibbles(indices)
+        path = self.path(fingerprint, source, asset_id)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(indices), allow_pickle=False)
+            size = os.path.getsize(tmp_path)
+            with self.lock:
+                replaced = os.path.getsize(path) if os.path.exists(path) else None
+                os.replace(tmp_path, path)
+                if self.frames is not None:
+                    self.frames += replaced is None
+                    self.size += size - (replaced or 0)
+        except Exception as e:
+            print(f"Error storing frame {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _write(self, path, content):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def fingerprints(self):
+        """ Fingerprints with a directory in the store """
+        result = []
+        for name in os.listdir(self.root):
+            try:
+                with open(os.path.join(self.root, name, 'fingerprint.json'), 'r') as f:
+                    result.append(tuple(json.load(f)))
+            except (OSError, ValueError):
+                continue
+        return result
+
+    def prune(self, keep):
+        """
+        Remove the frames of outdated settings
+
+        Fingerprints start with the panel name; for every panel in keep, the
+        directories of its other fingerprints are deleted.
+        """
+        keep_keys = {fingerprint_key(fingerprint) for fingerprint in keep}
+        panels = {fingerprint[0] for fingerprint in keep}
+        for fingerprint in self.fingerprints():
+            key = fingerprint_key(fingerprint)
+            if fingerprint[0] in panels and key not in keep_keys:
+                print(f"Removing stored frames of outdated settings {fingerprint}")
+                directory = os.path.join(self.root, key)
+                with self.lock:
+                    if self.frames is not None:
+                        frames, size = self._count(directory)
+                        self.frames -= frames
+                        self.size -= size
+                    shutil.rmtree(directory, ignore_errors=True)
+
+    def remove_missing(self, fingerprints, source, asset_ids):
+        """
+        Remove the frames of photos that are no longer listed
+
+        :param fingerprints: render fingerprints whose directories are cleaned
+        :param source: photo source the listing comes from
+        :param asset_ids: store IDs of every listed photo
+        :return: number of frames removed
+        """
+        keep = {f"{source}-{asset_id}.npy" for asset_id in asset_ids}
+        removed = 0
+        for fingerprint in fingerprints:
+            directory = self._dir(fingerprint)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith('.npy') or not name.startswith(f"{source}-") or name in keep:
+                    continue
+                removed += self._remove(os.path.join(directory, name))
+        return removed
+
+    def _remove(self, path):
+        """ Delete a stored frame and update the counts, 1 when it was deleted """
+        with self.lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return 0
+            if self.frames is not None:
+                self.frames -= 1
+                self.size -= size
+        return 1
+
+    def _evict(self):
+        """ Remove the least recently used frames while the store is over max_bytes """
+        if self.max_bytes <= 0:
+            return
+        with self.lock:
+            if self.frames is None:
+                self.frames, self.size = self._count(self.root)
+            if self.size <= self.max_bytes:
+                return
+            entries = []
+            for directory, _, files in os.walk(self.root):
+                for name in files:
+                    if name.endswith('.npy'):
+                        path = os.path.join(directory, name)
+                        try:
+                            stat = os.stat(path)
+                        except OSError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, path))
+            entries.sort()
+            removed = 0
+            for _, size, path in entries:
+                if self.size <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.frames -= 1
+                self.size -= size
+                removed += 1
+        print(f"Frame store over {self.max_bytes // (1024 * 1024)} MB, removed {removed} least recently used frames")
+
+    @staticmethod
+    def _count(root):
+        """ Frames and bytes stored under root """
+        frames = 0
+        size = 0
+        for directory, _, files in os.walk(root):
+            for name in files:
+                if name.endswith('.npy'):
+                    try:
+                        size += os.path.getsize(os.path.join(directory, name))
+                    except OSError:
+                        continue
+                    frames += 1
+        return frames, size
+
+    def status(self):
+        """ Stored frames, disk usage and hit counts """
+        with self.lock:
+            if self.frames is None:
+                self.frames, self.size = self._count(self.root)
+            frames, size = self.frames, self.size
+        return {'frames': frames, 'size_mb': round(size / (1024 * 1024), 1),
+                'max_mb': round(self.max_bytes / (1024 * 1024), 1),
+                'hits': self.hits, 'misses': self.misses}
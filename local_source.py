@@ -0,0 +1,264 @@
+#-*- coding:utf8 -*-
+"""
+Local directory photo source
+
+Indexes the photos below a directory (path, mtime, EXIF date, dimensions,
+orientation) in a small SQLite store and keeps it current with watchdog, so
+frames can be served from local disk without asking Immich. Only files whose
+mtime or size changed are read again, at startup and on every file event.
+Photos are handed to the SelectionEngine as Immich-like asset dictionaries.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from PIL import Image
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+# Album ID of the local directory in the SelectionEngine
+LOCAL_ALBUM_ID = 'local'
+
+PHOTO_EXTENSIONS = ('.jpeg', '.jpg', '.bmp', '.png', '.heic', '.raw', '.dng', '.arw', '.cr2', '.nef')
+RAW_EXTENSIONS = ('.raw', '.dng', '.arw', '.cr2', '.nef')
+
+# EXIF tags
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 306
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 36867
+
+
+def asset_id_for(relpath):
+    """ Stable ID of a file, safe to use in file names """
+    return hashlib.sha1(relpath.encode('utf-8')).hexdigest()[:16]
+
+
+def parse_exif_date(value):
+    """ EXIF "YYYY:MM:DD HH:MM:SS" to the ISO format used by Immich, None when invalid """
+    try:
+        return datetime.strptime(str(value).strip().rstrip('\x00'), "%Y:%m:%d %H:%M:%S").strftime('%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+
+
+def read_photo_info(path):
+    """
+    Read dimensions, orientation and capture date without decoding the image
+
+    :return: (width, height, orientation, date) or None when the file cannot be read,
+             e.g. because it is still being copied
+    """
+    width = height = None
+    orientation = 1
+    date = None
+    lower = path.lower()
+    try:
+        if lower.endswith(RAW_EXTENSIONS):
+            import rawpy
+            with rawpy.imread(path) as raw:
+                height, width = raw.sizes.height, raw.sizes.width
+                orientation = {3: 3, 5: 8, 6: 6}.get(raw.sizes.flip, 1)
+        else:
+            if lower.endswith('.heic'):
+                from pillow_heif import register_heif_opener
+                register_heif_opener()
+            with Image.open(path) as image:
+                width, height = image.size
+                exif = image.getexif()
+                orientation = exif.get(TAG_ORIENTATION) or 1
+                date = parse_exif_date(exif.get_ifd(TAG_EXIF_IFD).get(TAG_DATETIME_ORIGINAL) or exif.get(TAG_DATETIME) or '')
+    except Exception as e:
+        print(f"Cannot index {path}: {e}")
+        return None
+    return width, height, orientation, date
+
+
+class LocalPhotoIndex:
+    """ Persistent index of the photos below a directory """
+    def __init__(self, root, store_path, exclude=()):
+        """
+        :param root: directory tree to index
+        :param store_path: SQLite file holding the index
+        :param exclude: directories below root that are never indexed
+        """
+        self.root = os.path.abspath(root)
+        self.exclude = [os.path.abspath(path) for path in exclude]
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        self.db = sqlite3.connect(store_path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS photos (
+            path TEXT PRIMARY KEY, id TEXT, mtime REAL, size INTEGER,
+            taken TEXT, width INTEGER, height INTEGER, orientation INTEGER)""")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        self.db.commit()
+        # In-memory copy of the store, asset ID -> row
+        self.rows = {}
+        for row in self.db.execute("SELECT path, id, mtime, size, taken, width, height, orientation FROM photos"):
+            self.rows[row[1]] = row
+        self.paths = {row[0]: row[1] for row in self.rows.values()}
+        version = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        self.version = version[0] if version else 0
+
+    def _relpath(self, path):
+        """ Path relative to root, None for files that are not indexed """
+        path = os.path.abspath(path)
+        if not path.startswith(self.root + os.sep):
+            return None
+        if any(path == excluded or path.startswith(excluded + os.sep) for excluded in self.exclude):
+            return None
+        relpath = os.path.relpath(path, self.root)
+        if any(part.startswith('.') for part in relpath.split(os.sep)):
+            return None
+        if not relpath.lower().endswith(PHOTO_EXTENSIONS):
+            return None
+        return relpath
+
+    def _bump(self):
+        self.version += 1
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (self.version,))
+
+    def update(self, path):
+        """ Add or refresh the entry of one file, True when the index changed """
+        relpath = self._relpath(path)
+        if relpath is None:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return self.remove(path)
+        with self.lock:
+            asset_id = self.paths.get(relpath)
+            row = self.rows.get(asset_id)
+            if row is not None and row[2] == stat.st_mtime and row[3] == stat.st_size:
+                return False
+        info = read_photo_info(path)
+        if info is None:
+            return self.remove(path)
+        width, height, orientation, taken = info
+        if taken is None:
+            taken = datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%dT%H:%M:%S')
+        row = (relpath, asset_id_for(relpath), stat.st_mtime, stat.st_size, taken, width, height, orientation)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self._bump()
+            self.db.commit()
+            self.rows[row[1]] = row
+            self.paths[relpath] = row[1]
+        return True
+
+    def remove(self, path):
+        """ Drop the entry of one file, or of every file below a directory """
+        relpath = os.path.relpath(os.path.abspath(path), self.root)
+        with self.lock:
+            removed = [entry for entry in self.paths
+                       if entry == relpath or entry.startswith(relpath + os.sep)]
+            if not removed:
+                return False
+            self.db.executemany("DELETE FROM photos WHERE path = ?", [(entry,) for entry in removed])
+            self._bump()
+            self.db.commit()
+            for entry in removed:
+                self.rows.pop(self.paths.pop(entry), None)
+        return True
+
+    def scan(self, directory=None):
+        """
+        Bring the index of a directory tree up to date
+
+        Unchanged files are only stat()ed, files that disappeared while the
+        server was down are removed.
+        """
+        directory = os.path.abspath(directory or self.root)
+        seen = set()
+        added = 0
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames[:] = [name for name in dirnames
+                           if not name.startswith('.') and os.path.join(dirpath, name) not in self.exclude]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                relpath = self._relpath(path)
+                if relpath is None:
+                    continue
+                seen.add(relpath)
+                added += self.update(path)
+        prefix = '' if directory == self.root else os.path.relpath(directory, self.root) + os.sep
+        with self.lock:
+            missing = [relpath for relpath in self.paths if relpath.startswith(prefix) and relpath not in seen]
+        for relpath in missing:
+            self.remove(os.path.join(self.root, relpath))
+        if added or missing:
+            print(f"Local photo index: {added} updated, {len(missing)} removed, {len(self.rows)} photos")
+
+    def fingerprint(self):
+        """ Changes whenever an entry is added, updated or removed """
+        return f"{len(self.rows)}|{self.version}"
+
+    def _asset(self, row):
+        relpath, asset_id, mtime, size, taken, width, height, orientation = row
+        return {
+            'id': asset_id,
+            'originalPath': os.path.join(self.root, relpath),
+            'originalFileName': os.path.basename(relpath),
+            'fileModifiedAt': datetime.fromtimestamp(mtime).isoformat(),
+            'exifInfo': {
+                'dateTimeOriginal': taken,
+                'exifImageWidth': width,
+                'exifImageHeight': height,
+                'orientation': str(orientation),
+                'fileSizeInByte': size,
+            },
+        }
+
+    def asset(self, asset_id):
+        """ Asset dictionary of one photo, None when it is not indexed """
+        with self.lock:
+            row = self.rows.get(asset_id)
+        return self._asset(row) if row is not None else None
+
+    def assets(self):
+        """ Asset dictionaries of every indexed photo """
+        with self.lock:
+            rows = list(self.rows.values())
+        return [self._asset(row) for row in rows]
+
+
+class LocalPhotoHandler(FileSystemEventHandler):
+    """ Apply file system events to the index, one entry at a time """
+    def __init__(self, index):
+        self.index = index
+
+    def on_created(self, event):
+        if event.is_directory:
+            # Files moved in together with their directory raise no events of their own
+            self.index.scan(event.src_path)
+        else:
+            self.index.update(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.index.update(event.src_path)
+
+    def on_deleted(self, event):
+        self.index.remove(event.src_path)
+
+    def on_moved(self, event):
+        self.index.remove(event.src_path)
+        if event.is_directory:
+            self.index.scan(event.dest_path)
+        else:
+            self.index.update(event.dest_path)
+
+
+def start_local_index(root, store_path, exclude=()):
+    """ Scan the directory, then keep the index updated in the background """
+    index = LocalPhotoIndex(root, store_path, exclude)
+    index.scan()
+    observer = Observer()
+    observer.schedule(LocalPhotoHandler(index), path=index.root, recursive=True)
+    observer.daemon = True
+    observer.start()
+    print(f"Watching {index.root} for photos ({len(index.rows)} indexed)")
+    return index, observer
@@ -0,0 +1,412 @@
+#-*- coding:utf8 -*-
+"""
+Memory budget for image rendering
+
+- Admission control: renders reserve their estimated peak memory before they
+  start and wait while the configured budget is exhausted.
+- Buffer pool: frame sized arrays are checked out of a bounded pool for a
+  render and returned afterwards, so they are reused across requests even
+  though the server starts a new thread for every request.
+- Accounting: peak memory of every render stage, from the start of the
+  render, is sampled from RSS (and from tracemalloc when enabled) so the
+  number of concurrent renders that fit in the budget can be read from
+  /memory. Both are process-wide: concurrent renders add to each other's
+  peaks, and memory the allocator kept from an earlier render makes RSS
+  deltas read low. tracemalloc does not see Pillow's pixel buffers or
+  LibRaw's memory, so it reads far lower than RSS for decoding. Only renders
+  that ran alone are used for sizing, from the larger of both peaks.
+"""
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+# Total memory (MB) concurrent renders may use, 0 disables the budgeted mode
+MEMORY_BUDGET_MB = int(os.getenv('RENDER_MEMORY_BUDGET_MB', '0'))
+# Seconds a render waits for room in the budget before the request is deferred
+ADMISSION_TIMEOUT = float(os.getenv('RENDER_ADMISSION_TIMEOUT', '30'))
+# Trace Python/NumPy allocations with tracemalloc (slows rendering down)
+MEMORY_TRACE = os.getenv('RENDER_MEMORY_TRACE', '0') == '1'
+
+# Idle FrameBuffers kept per panel size, renders beyond it allocate temporary ones
+FRAME_BUFFER_POOL = int(os.getenv('RENDER_BUFFER_POOL', '4'))
+
+# Rows handled at once by the strip based palette mapping
+STRIP_ROWS = 48
+
+# Fallback source size when Immich has no EXIF dimensions (24 MP)
+DEFAULT_SOURCE_PIXELS = 6000 * 4000
+# Bytes per source pixel alive at the same time while decoding and scaling
+# (PIL keeps RGB as 4 bytes/pixel: decoded original, copy and rotated copy)
+BYTES_PER_SOURCE_PIXEL = 12
+# LibRaw keeps the 16-bit mosaic plus a 4x16-bit working image next to the
+# 8-bit RGB output of postprocess()
+BYTES_PER_RAW_PIXEL = 2 + 8 + 3
+# Bytes per panel pixel: scaled and two ImageEnhance images, dithering arrays
+BYTES_PER_FRAME_PIXEL = 4 * 3 + 3 + 1
+# Palette mapping strips, packed frame and its hex text
+FRAME_OVERHEAD_BYTES = 16 * 1024 * 1024
+
+RAW_EXTENSIONS = ('.raw', '.dng', '.arw', '.cr2', '.nef')
+# Only JPEG decoders honour Image.draft(), other formats decode at full size
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+MB = 1024 * 1024
+
+
+def budget_enabled():
+    """ Return True when the memory-budgeted pipeline mode is active """
+    return MEMORY_BUDGET_MB > 0
+
+
+def current_rss():
+    """ Current resident set size of this process in bytes (0 if unknown) """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def estimate_render_bytes(asset, frame_pixels=800 * 480):
+    """
+    Estimate the peak memory of rendering an Immich asset
+
+    :param asset: asset dictionary from the Immich album API
+    :param frame_pixels: panel resolution (width * height)
+    :return: estimated peak bytes
+    """
+    exif = asset.get('exifInfo') or {}
+    width = exif.get('exifImageWidth') or 0
+    height = exif.get('exifImageHeight') or 0
+    pixels = width * height if width and height else DEFAULT_SOURCE_PIXELS
+    file_size = exif.get('fileSizeInByte') or 0
+    path = asset.get('originalPath', '').lower()
+    is_raw = path.endswith(RAW_EXTENSIONS)
+
+    if is_raw:
+        per_pixel = BYTES_PER_RAW_PIXEL
+        if budget_enabled():
+            # Half size postprocessing shrinks the working and output images 4x
+            per_pixel = 2 + (8 + 3) / 4 + BYTES_PER_SOURCE_PIXEL / 4
+        else:
+            per_pixel += BYTES_PER_SOURCE_PIXEL
+    else:
+        per_pixel = BYTES_PER_SOURCE_PIXEL
+        if budget_enabled() and path.endswith(JPEG_EXTENSIONS):
+            # JPEG draft mode decodes at 1/2..1/8 scale, assume the worst case
+            per_pixel = BYTES_PER_SOURCE_PIXEL / 4
+
+    return int(pixels * per_pixel + file_size + frame_pixels * BYTES_PER_FRAME_PIXEL + FRAME_OVERHEAD_BYTES)
+
+
+class MemoryBudget:
+    """ Admit renders while the sum of their estimated peaks fits the budget """
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.reserved = 0
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes, timeout=ADMISSION_TIMEOUT):
+        """
+        Reserve nbytes, waiting up to timeout seconds for room
+
+        A render larger than the whole budget is still admitted when nothing
+        else is running so that it cannot starve.
+        :return: True when admitted, False on timeout
+        """
+        if self.budget_bytes <= 0:
+            with self.condition:
+                self.active += 1
+            return True
+
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.active and self.reserved + nbytes > self.budget_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.reserved += nbytes
+            self.active += 1
+            return True
+
+    def release(self, nbytes):
+        """ Return a reservation made by acquire() """
+        with self.condition:
+            if self.budget_bytes > 0:
+                self.reserved = max(0, self.reserved - nbytes)
+            self.active = max(0, self.active - 1)
+            self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            return {
+                'budget_mb': round(self.budget_bytes / MB, 1),
+                'reserved_mb': round(self.reserved / MB, 1),
+                'active_renders': self.active,
+            }
+
+
+render_budget = MemoryBudget(MEMORY_BUDGET_MB * MB)
+
+
+class FrameBuffers:
+    """ Frame sized arrays reused across requests, see frame_buffers() """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.work = np.empty((height, width, 3), dtype=np.uint8)
+        self.indices = np.empty((height, width), dtype=np.uint8)
+        # Large enough for 4 bits per pixel, smaller depths use a prefix
+        self.packed = np.empty(height * ((width + 1) // 2), dtype=np.uint8)
+
+
+class FrameBufferPool:
+    """ Idle FrameBuffers per panel size, at most FRAME_BUFFER_POOL of each """
+    def __init__(self, size=FRAME_BUFFER_POOL):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.allocated = 0
+
+    def checkout(self, width, height):
+        with self.lock:
+            idle = self.idle.get((width, height))
+            if idle:
+                return idle.pop()
+            self.allocated += 1
+        return FrameBuffers(width, height)
+
+    def checkin(self, buffers):
+        with self.lock:
+            idle = self.idle.setdefault((buffers.width, buffers.height), [])
+            if len(idle) < self.size:
+                idle.append(buffers)
+
+    def status(self):
+        with self.lock:
+            return {'allocated': self.allocated,
+                    'idle': sum(len(idle) for idle in self.idle.values())}
+
+
+buffer_pool = FrameBufferPool()
+
+
+@contextmanager
+def frame_buffers(width, height):
+    """ FrameBuffers for a panel size from the pool, returned when the block exits """
+    buffers = buffer_pool.checkout(width, height)
+    try:
+        yield buffers
+    finally:
+        buffer_pool.checkin(buffers)
+
+
+class _RssSampler(threading.Thread):
+    """ Poll RSS while stages are running and record the highest value seen """
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.watchers = []
+        self.wakeup = threading.Event()
+
+    def watch(self, record):
+        with self.lock:
+            self.watchers.append(record)
+        self.wakeup.set()
+
+    def unwatch(self, record):
+        with self.lock:
+            # Records of concurrent stages may compare equal, remove by identity
+            self.watchers = [watcher for watcher in self.watchers if watcher is not record]
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            rss = current_rss()
+            with self.lock:
+                if not self.watchers:
+                    self.wakeup.clear()
+                for record in self.watchers:
+                    if rss > record['rss_peak']:
+                        record['rss_peak'] = rss
+            time.sleep(self.interval)
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def _get_sampler():
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = _RssSampler()
+            _sampler.start()
+        return _sampler
+
+
+class RenderStats:
+    """ Peak memory per stage aggregated over all renders """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.renders = 0
+        self.overlapped = 0
+        self.peak_render_bytes = 0
+        self.traced_peak_render_bytes = 0
+        self.last_render = {}
+
+    def record(self, profile):
+        with self.lock:
+            self.renders += 1
+            self.last_render = profile.summary()
+            if profile.overlapped:
+                # Other renders inflated this one's peaks, don't size the budget from it
+                self.overlapped += 1
+            else:
+                self.peak_render_bytes = max(self.peak_render_bytes, profile.peak_bytes())
+                self.traced_peak_render_bytes = max(self.traced_peak_render_bytes, profile.peak_bytes(traced=True))
+            for name, stage in profile.stages.items():
+                agg = self.stages.setdefault(name, {'count': 0, 'peak_mb': 0.0, 'traced_peak_mb': 0.0, 'seconds': 0.0})
+                agg['count'] += 1
+                agg['peak_mb'] = max(agg['peak_mb'], stage['peak_mb'])
+                agg['traced_peak_mb'] = max(agg['traced_peak_mb'], stage['traced_peak_mb'])
+                agg['seconds'] += stage['seconds']
+
+    def summary(self):
+        with self.lock:
+            stages = {
+                name: {
+                    'count': agg['count'],
+                    'peak_mb': agg['peak_mb'],
+                    'traced_peak_mb': agg['traced_peak_mb'],
+                    'avg_seconds': round(agg['seconds'] / agg['count'], 4),
+                }
+                for name, agg in self.stages.items()
+            }
+            peak_mb = round(self.peak_render_bytes / MB, 1)
+            # tracemalloc misses Pillow and LibRaw buffers, it only helps when RSS reads low
+            sizing_bytes, source = self.peak_render_bytes, 'rss'
+            if self.traced_peak_render_bytes > sizing_bytes:
+                sizing_bytes, source = self.traced_peak_render_bytes, 'tracemalloc'
+            fits = None
+            if MEMORY_BUDGET_MB > 0 and sizing_bytes > 0:
+                fits = int(MEMORY_BUDGET_MB * MB // sizing_bytes)
+            return {
+                'renders': self.renders,
+                'overlapped_renders': self.overlapped,
+                'peak_render_mb': peak_mb,
+                'traced_peak_render_mb': round(self.traced_peak_render_bytes / MB, 1),
+                'concurrent_renders_fit': fits,
+                'concurrent_renders_fit_source': source,
+                'note': "Stage peaks are process-wide and approximate: concurrent renders add to each other's "
+                        "peaks, memory kept by the allocator reads as 0 in RSS and tracemalloc does not see "
+                        "Pillow or LibRaw buffers. Renders that ran alone are sized from the larger of both.",
+                'stages': stages,
+                'last_render': self.last_render,
+            }
+
+
+render_stats = RenderStats()
+
+
+_active_profiles = []
+_active_lock = threading.Lock()
+
+
+class RenderProfile:
+    """ Peak memory of the stages of a single render """
+    def __init__(self):
+        self.base_rss = current_rss()
+        # Stage peaks are measured from the start of the render
+        self.traced_base = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        self.stages = {}
+        # Set when another render ran at the same time
+        self.overlapped = False
+
+    def begin(self):
+        with _active_lock:
+            if _active_profiles:
+                self.overlapped = True
+                for profile in _active_profiles:
+                    profile.overlapped = True
+            _active_profiles.append(self)
+
+    def end(self):
+        with _active_lock:
+            _active_profiles[:] = [profile for profile in _active_profiles if profile is not self]
+
+    @contextmanager
+    def stage(self, name):
+        record = {'rss_peak': current_rss()}
+        sampler = _get_sampler()
+        sampler.watch(record)
+        tracing = MEMORY_TRACE and tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            sampler.unwatch(record)
+            rss_peak = max(record['rss_peak'], current_rss())
+            traced_peak = 0
+            if tracing:
+                traced_peak = max(0, tracemalloc.get_traced_memory()[1] - self.traced_base)
+            self.stages[name] = {
+                'peak_mb': round(max(0, rss_peak - self.base_rss) / MB, 1),
+                'traced_peak_mb': round(traced_peak / MB, 1),
+                'seconds': round(elapsed, 4),
+            }
+
+    def peak_bytes(self, traced=False):
+        if not self.stages:
+            return 0
+        key = 'traced_peak_mb' if traced else 'peak_mb'
+        return int(max(stage[key] for stage in self.stages.values()) * MB)
+
+    def summary(self):
+        return dict(self.stages)
+
+
+@contextmanager
+def admitted_render(nbytes):
+    """
+    Reserve memory for a render and profile it
+
+    Yields a RenderProfile, or None when the budget stayed exhausted for
+    ADMISSION_TIMEOUT seconds.
+    """
+    if not render_budget.acquire(nbytes):
+        yield None
+        return
+    profile = RenderProfile()
+    profile.begin()
+    try:
+        yield profile
+    finally:
+        profile.end()
+        render_budget.release(nbytes)
+        render_stats.record(profile)
+
+
+def memory_status():
+    """ Budget state and per-stage statistics for the /memory endpoint """
+    status = render_budget.status()
+    status['trace'] = MEMORY_TRACE
+    status['rss_mb'] = round(current_rss() / MB, 1)
+    status['frame_buffers'] = buffer_pool.status()
+    status.update(render_stats.summary())
+    return status
+
+
+if MEMORY_TRACE and not tracemalloc.is_tracing():
+    tracemalloc.start()
@@ -0,0 +1,140 @@
+#-*- coding:utf8 -*-
+"""
+Ordered dithering threshold maps and palette lookup table
+
+Ordered dithering adds a position-dependent offset from a tiled threshold
+map to every pixel and looks up the nearest palette color in a precomputed
+RGB table. No pixel depends on another, so the engines run it vectorized
+(NumPy) or across cores (Cython prange) in a few milliseconds, at some cost
+in quality compared to error diffusion.
+
+Offsets are integers, so both engines give identical output.
+"""
+import functools
+
+import numpy as np
+
+# Dithering modes, 'diffusion' is Floyd-Steinberg error diffusion
+DITHER_MODES = ('diffusion', 'bayer', 'bluenoise')
+ORDERED_MODES = ('bayer', 'bluenoise')
+
+# Bits per channel of the palette lookup table
+LUT_BITS = 6
+
+BAYER_SIZE = 8
+BLUE_NOISE_SIZE = 64
+
+
+def bayer_matrix(size=BAYER_SIZE):
+    """ (size, size) Bayer threshold matrix with values in (0, 1), size a power of two """
+    m = np.zeros((1, 1))
+    while m.shape[0] < size:
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return (m + 0.5) / m.size
+
+
+def blue_noise_tile(size=BLUE_NOISE_SIZE, sigma=1.5, seed=0):
+    """
+    (size, size) blue-noise threshold tile with values in (0, 1)
+
+    Generated with Ulichney's void-and-cluster method on a torus, so the
+    tile repeats without seams. Deterministic for a given seed.
+    """
+    n = size * size
+    distance = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(distance[:, None] ** 2 + distance[None, :] ** 2) / (2 * sigma ** 2))
+
+    def splat(energy, index, sign):
+        y, x = divmod(index, size)
+        energy += sign * np.roll(kernel, (y, x), axis=(0, 1))
+
+    def tightest_cluster(pattern, energy):
+        return int(np.argmax(np.where(pattern, energy, -np.inf)))
+
+    def largest_void(pattern, energy):
+        return int(np.argmin(np.where(pattern, np.inf, energy)))
+
+    rng = np.random.default_rng(seed)
+    pattern = np.zeros((size, size), dtype=bool)
+    pattern.flat[rng.choice(n, n // 10, replace=False)] = True
+    energy = np.real(np.fft.ifft2(np.fft.fft2(pattern) * np.fft.fft2(kernel)))
+
+    # Spread the initial points evenly: move the tightest cluster into the largest void
+    while True:
+        cluster = tightest_cluster(pattern, energy)
+        pattern.flat[cluster] = False
+        splat(energy, cluster, -1)
+        void = largest_void(pattern, energy)
+        pattern.flat[void] = True
+        splat(energy, void, 1)
+        if void == cluster:
+            break
+
+    ranks = np.zeros(n, dtype=np.int64)
+    ones = int(pattern.sum())
+
+    # Rank the initial points by removing tightest clusters first
+    removing, removing_energy = pattern.copy(), energy.copy()
+    for rank in range(ones - 1, -1, -1):
+        cluster = tightest_cluster(removing, removing_energy)
+        removing.flat[cluster] = False
+        splat(removing_energy, cluster, -1)
+        ranks[cluster] = rank
+
+    # Rank the remaining points by filling the largest voids first
+    for rank in range(ones, n):
+        void = largest_void(pattern, energy)
+        pattern.flat[void] = True
+        splat(energy, void, 1)
+        ranks[void] = rank
+
+    return ((ranks + 0.5) / n).reshape(size, size)
+
+
+@functools.lru_cache(maxsize=4)
+def threshold_map(mode):
+    """ Threshold map of an ordered dithering mode """
+    if mode == 'bayer':
+        return bayer_matrix()
+    if mode == 'bluenoise':
+        return blue_noise_tile()
+    raise ValueError(f"Unknown ordered dithering mode: {mode}")
+
+
+@functools.lru_cache(maxsize=16)
+def threshold_offsets(mode, strength):
+    """
+    Per-position offsets added to every channel before the palette lookup
+
+    At strength 1 the offsets span one full black to white step, so a mid
+    gray dithers to half black and half white pixels.
+    :return: (h, w) int16 array
+    """
+    offsets = (threshold_map(mode) - 0.5) * 255 * strength
+    return np.round(offsets).astype(np.int16)
+
+
+@functools.lru_cache(maxsize=8)
+def _palette_lut(colors_bytes, ncolors):
+    colors = np.frombuffer(colors_bytes, dtype=np.float64).reshape(ncolors, 3)
+    size = 1 << LUT_BITS
+    # Center of every table cell, in 0..1 like the palette
+    centers = ((np.arange(size) << (8 - LUT_BITS)) + (1 << (7 - LUT_BITS))) / 255.0
+    lut = np.empty((size, size, size), dtype=np.uint8)
+    for r in range(size):
+        d = (centers[None, :, None, None] - colors[None, None, None, :, 1]) ** 2
+        d = d + (centers[None, None, :, None] - colors[None, None, None, :, 2]) ** 2
+        d = d + (centers[r] - colors[None, None, None, :, 0]) ** 2
+        lut[r] = np.argmin(d[0], axis=2)
+    return lut
+
+
+def palette_lut(colors):
+    """
+    Nearest palette index for every RGB value, LUT_BITS per channel
+
+    :param colors: (N, 3) palette colors in 0..1
+    :return: (2**LUT_BITS,) * 3 uint8 array indexed by [r, g, b] >> (8 - LUT_BITS)
+    """
+    colors = np.ascontiguousarray(colors, dtype=np.float64)
+    return _palette_lut(colors.tobytes(), colors.shape[0])
@@ -0,0 +1,194 @@
+#-*- coding:utf8 -*-
+"""
+Overlay compositor
+
+Draws captions (photo date, battery level, status badge) straight into the
+dithered frame of palette indices, after quantization, so text stays crisp
+instead of being dithered into noise. Glyphs are rasterized once per font and
+size into 1-bit masks; drawing a caption is a few array slices.
+
+Overlays are laid out as the viewer sees the photo. The frame was rotated by
+the configured angle, so they are drawn through a rotated view of the index
+array, which writes into the frame without rotating any pixels.
+"""
+import functools
+import string
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+# Characters rasterized up front, others are added on first use
+OVERLAY_CHARSET = string.digits + string.ascii_letters + " %/:.-"
+
+OVERLAY_NAMES = ('date', 'battery', 'status')
+
+# Battery percentage at which the battery level turns red
+LOW_BATTERY = 15
+
+
+class GlyphAtlas:
+    """ 1-bit masks and advances of the glyphs of one font and size """
+    def __init__(self, font_path, size):
+        try:
+            self.font = ImageFont.truetype(font_path, size)
+        except OSError:
+            self.font = ImageFont.load_default(size)
+        ascent, descent = self.font.getmetrics()
+        self.height = ascent + descent
+        self.glyphs = {}
+        for char in OVERLAY_CHARSET:
+            self.glyph(char)
+
+    def glyph(self, char):
+        """ (height, advance) bool mask of a character """
+        mask = self.glyphs.get(char)
+        if mask is None:
+            advance = max(1, int(round(self.font.getlength(char))))
+            image = Image.new('1', (advance, self.height), 0)
+            draw = ImageDraw.Draw(image)
+            # Aliased rendering, every pixel is either ink or background
+            draw.fontmode = '1'
+            draw.text((0, 0), char, font=self.font, fill=1)
+            mask = np.array(image, dtype=bool)
+            self.glyphs[char] = mask
+        return mask
+
+    def render(self, text):
+        """ (height, width) bool mask of a line of text """
+        masks = [self.glyph(char) for char in text]
+        if not masks:
+            return np.zeros((self.height, 0), dtype=bool)
+        return np.concatenate(masks, axis=1)
+
+
+@functools.lru_cache(maxsize=8)
+def glyph_atlas(font_path, size):
+    """ Atlas of a font and size, rasterized on first use """
+    return GlyphAtlas(font_path, size)
+
+
+def upright_view(indices, rotation):
+    """ View of the frame as the viewer sees it, writes go into the frame """
+    return np.rot90(indices, -(rotation // 90) % 4)
+
+
+def format_date(value):
+    """ "YYYY/MM/DD" from an ISO or EXIF date, None when it can't be read """
+    if not value:
+        return None
+    date = str(value)[:10].replace('-', '/').replace(':', '/').replace('.', '/')
+    if len(date) != 10 or not date.replace('/', '').isdigit():
+        return None
+    return date
+
+
+def color_index(panel, name, default=0):
+    """ Palette index of a named panel color """
+    return panel.color_names.index(name) if name in panel.color_names else default
+
+
+def draw_label(view, text, atlas, x, y, fg, bg, padding):
+    """
+    Draw text on a filled box with its top left corner at (x, y)
+
+    :return: (width, height) of the box
+    """
+    mask = atlas.render(text)
+    height, width = mask.shape[0] + 2 * padding, mask.shape[1] + 2 * padding
+    box = view[y:y + height, x:x + width]
+    box[...] = bg
+    box[padding:padding + mask.shape[0], padding:padding + mask.shape[1]][mask] = fg
+    return width, height
+
+
+def battery_icon_size(atlas):
+    """ (width, height, nub) of the battery icon """
+    height = atlas.height * 2 // 3
+    return height * 2, height, max(2, height // 6)
+
+
+def battery_width(atlas, label, padding):
+    """ Width of the battery icon and label box """
+    icon_width, _, nub = battery_icon_size(atlas)
+    return padding + icon_width + nub + atlas.render(label).shape[1] + 2 * padding
+
+
+def draw_battery(view, percentage, atlas, x, y, fg, bg, level_color, padding):
+    """ Battery icon filled to the charge level, followed by the percentage """
+    label = f"{percentage:.0f}%"
+    icon_width, icon_height, nub = battery_icon_size(atlas)
+    width = battery_width(atlas, label, padding)
+    height = atlas.height + 2 * padding
+    view[y:y + height, x:x + width] = bg
+
+    # Outline, terminal and charge level
+    top = y + padding + (atlas.height - icon_height) // 2
+    left = x + padding
+    border = max(1, icon_height // 8)
+    view[top:top + icon_height, left:left + icon_width] = fg
+    view[top + border:top + icon_height - border, left + border:left + icon_width - border] = bg
+    view[top + icon_height // 3:top + icon_height - icon_height // 3, left + icon_width:left + icon_width + nub] = fg
+    level = int(round((icon_width - 4 * border) * max(0, min(100, percentage)) / 100))
+    view[top + 2 * border:top + icon_height - 2 * border, left + 2 * border:left + 2 * border + level] = level_color
+
+    draw_label(view, label, atlas, left + icon_width + nub, y, fg, bg, padding)
+    return width, height
+
+
+def draw_overlays(indices, panel, rotation, overlays, date=None, battery=None, status=None, font_path=FONT_PATH):
+    """
+    Draw the enabled overlays into a frame of palette indices
+
+    :param indices: (panel.height, panel.width) uint8 array from render_frame(), changed in place
+    :param panel: PanelProfile of the frame
+    :param rotation: rotation applied to the photo (0, 90, 180, 270)
+    :param overlays: names of the enabled overlays, see OVERLAY_NAMES
+    :param date: capture date of the photo (ISO or EXIF format)
+    :param battery: battery percentage, None when the frame did not report it
+    :param status: short status text shown in a badge, None for no badge
+    :return: indices
+    """
+    overlays = set(overlays or ())
+    if not overlays:
+        return indices
+
+    view = upright_view(indices, rotation)
+    view_height, view_width = view.shape
+    size = max(12, panel.height // 24)
+    atlas = glyph_atlas(font_path, size)
+    margin = size * 2
+    padding = max(2, size // 4)
+    black = color_index(panel, 'Black', 0)
+    white = color_index(panel, 'White', 1)
+    red = color_index(panel, 'Red', black)
+
+    # Labels that don't fit the frame are skipped instead of clipped
+    def fits(width, height):
+        return width + 2 * margin <= view_width and height + 2 * margin <= view_height
+
+    label_height = atlas.height + 2 * padding
+    if 'date' in overlays:
+        text = format_date(date)
+        if text:
+            width = atlas.render(text).shape[1] + 2 * padding
+            if fits(width, label_height):
+                # Bottom right
+                draw_label(view, text, atlas, view_width - margin - width, view_height - margin - label_height,
+                           white, black, padding)
+
+    if 'battery' in overlays and battery is not None:
+        level_color = red if battery <= LOW_BATTERY else white
+        width = battery_width(atlas, f"{battery:.0f}%", padding)
+        if fits(width, label_height):
+            # Top right
+            draw_battery(view, battery, atlas, view_width - margin - width, margin, white, black, level_color, padding)
+
+    if 'status' in overlays and status:
+        width = atlas.render(status).shape[1] + 2 * padding
+        if fits(width, label_height):
+            # Top left
+            draw_label(view, status, atlas, margin, margin, white, red, padding)
+
+    return indices
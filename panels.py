@@ -0,0 +1,137 @@
+#-*- coding:utf8 -*-
+"""
+Panel profiles
+
+A profile describes one e-paper panel: resolution, palette, the color code
+the controller expects for every palette entry, bits per pixel and the order
+in which packed bytes are sent. Devices pick their profile with the `panel`
+request header, otherwise the profile configured on the settings page is used.
+"""
+import numpy as np
+
+from engine import pack_indices
+
+
+class PanelProfile:
+    """ Resolution, palette and packing of an e-paper panel """
+    def __init__(self, name, description, width, height, colors, codes, bits_per_pixel=4, packing='rows',
+                 display_palette=None):
+        """
+        :param name: profile key used in the config and the `panel` header
+        :param description: label shown on the settings page
+        :param width: panel width in pixels
+        :param height: panel height in pixels
+        :param colors: (name, (r, g, b)) pairs with components in 0..1, used for dithering
+        :param codes: controller color code of every palette entry
+        :param bits_per_pixel: 4 (two pixels per byte) or 2 (four pixels per byte)
+        :param packing: 'rows' sends whole rows, 'halves' sends the left half of every
+                        row then the right half (panels driven by two controllers)
+        :param display_palette: measured 8-bit RGB of every palette entry, used to map
+                                rendered RGB images back to palette indices
+        """
+        assert len(colors) == len(codes), "Every palette color needs a panel code"
+        assert len(colors) <= 2 ** bits_per_pixel, "Palette too large for bits per pixel"
+        assert packing in ('rows', 'halves'), "Unknown packing order"
+        self.name = name
+        self.description = description
+        self.width = width
+        self.height = height
+        self.color_names = [color_name for color_name, _ in colors]
+        self.colors = np.array([rgb for _, rgb in colors], dtype=np.float64)
+        self.rgb = (self.colors * 255).astype(np.uint8)
+        self.codes = np.array(codes, dtype=np.uint8)
+        self.bits_per_pixel = bits_per_pixel
+        self.packing = packing
+        self.display_palette = display_palette or [tuple(int(v) for v in rgb) for rgb in self.rgb]
+
+    @property
+    def frame_bytes(self):
+        """ Size of a packed frame """
+        pixels_per_byte = 8 // self.bits_per_pixel
+        return self.height * -(-self.width // pixels_per_byte)
+
+    def pack(self, indices, out=None):
+        """
+        Pack a (height, width) array of palette indices into panel bytes
+
+        :param out: optional flat uint8 buffer of at least frame_bytes
+        :return: flat uint8 array of frame_bytes
+        """
+        if out is None:
+            out = np.empty(self.frame_bytes, dtype=np.uint8)
+        if self.packing == 'halves':
+            half = self.width // 2
+            left = pack_indices(indices[:, :half], self.codes, self.bits_per_pixel, out)
+            pack_indices(indices[:, half:], self.codes, self.bits_per_pixel, out[left.size:])
+            return out[:self.frame_bytes]
+        return pack_indices(indices, self.codes, self.bits_per_pixel, out)
+
+
+ACEP_7_COLORS = [
+    ('Black', (0, 0, 0)),
+    ('White', (1, 1, 1)),
+    ('Green', (0, 1, 0)),
+    ('Blue', (0, 0, 1)),
+    ('Red', (1, 0, 0)),
+    ('Yellow', (1, 1, 0)),
+    ('Orange', (1, 0.647, 0)),
+]
+
+# Measured colors of the 7.3inch ACeP e-Paper (F)
+ACEP_7_DISPLAY_PALETTE = [
+    (0, 0, 0),
+    (255, 255, 255),
+    (67, 138, 28),
+    (100, 64, 255),
+    (191, 0, 0),
+    (255, 243, 56),
+    (232, 126, 0),
+]
+
+SPECTRA_6_COLORS = [
+    ('Black', (0, 0, 0)),
+    ('White', (1, 1, 1)),
+    ('Yellow', (1, 1, 0)),
+    ('Red', (1, 0, 0)),
+    ('Blue', (0, 0, 1)),
+    ('Green', (0, 1, 0)),
+]
+# Spectra 6 controllers skip code 4
+SPECTRA_6_CODES = [0, 1, 2, 3, 5, 6]
+
+BWRY_4_COLORS = [
+    ('Black', (0, 0, 0)),
+    ('White', (1, 1, 1)),
+    ('Yellow', (1, 1, 0)),
+    ('Red', (1, 0, 0)),
+]
+
+DEFAULT_PANEL = 'epd7in3f'
+
+PANEL_PROFILES = {
+    profile.name: profile for profile in [
+        PanelProfile('epd7in3f', '7.3" ACeP 7-color (800x480)', 800, 480,
+                     ACEP_7_COLORS, range(7), display_palette=ACEP_7_DISPLAY_PALETTE),
+        PanelProfile('epd5in65f', '5.65" ACeP 7-color (600x448)', 600, 448,
+                     ACEP_7_COLORS, range(7), display_palette=ACEP_7_DISPLAY_PALETTE),
+        PanelProfile('epd7in3e', '7.3" Spectra 6 (800x480)', 800, 480,
+                     SPECTRA_6_COLORS, SPECTRA_6_CODES),
+        # Scans natively in portrait, each controller (CS_M/CS_S) takes 600 pixels of every
+        # 1200-pixel row; landscape photos are turned by the rotation setting
+        PanelProfile('epd13in3e', '13.3" Spectra 6 (1200x1600)', 1200, 1600,
+                     SPECTRA_6_COLORS, SPECTRA_6_CODES, packing='halves'),
+        PanelProfile('epd7in3g', '7.3" 4-color BWRY (800x480)', 800, 480,
+                     BWRY_4_COLORS, range(4), bits_per_pixel=2),
+        PanelProfile('epd4in37g', '4.37" 4-color BWRY (512x368)', 512, 368,
+                     BWRY_4_COLORS, range(4), bits_per_pixel=2),
+    ]
+}
+
+
+def get_panel(name=None):
+    """ Profile for a panel name, the default panel for unknown names """
+    if name and name in PANEL_PROFILES:
+        return PANEL_PROFILES[name]
+    if name:
+        print(f"Unknown panel profile '{name}', using {DEFAULT_PANEL}")
+    return PANEL_PROFILES[DEFAULT_PANEL]
@@ -0,0 +1,258 @@
+#-*- coding:utf8 -*-
+"""
+Asset selection engine
+
+Every album keeps a persisted play order (a shuffled permutation in random
+mode, newest first in newest mode) and a cursor into it, so picking the next
+photo is O(1) however large the album is. When the album changes, added
+assets are spliced into the unplayed part of the order and removed assets are
+dropped instead of starting over. Several albums can be rotated with weights.
+"""
+import json
+import os
+import random
+import threading
+
+DEFAULT_DATE = '1970-01-01T00:00:00'
+
+
+def asset_date(asset):
+    """ Capture time used to sort assets in newest mode """
+    return (asset.get('exifInfo') or {}).get('dateTimeOriginal') or DEFAULT_DATE
+
+
+def album_fingerprint(album):
+    """
+    Fingerprint of an album entry from the Immich album list
+
+    Returns None when Immich does not report modification times, which makes
+    the engine resync on every wake.
+    """
+    updated = album.get('updatedAt')
+    modified = album.get('lastModifiedAssetTimestamp')
+    if not updated and not modified:
+        return None
+    return f"{album.get('assetCount')}|{updated}|{modified}"
+
+
+def parse_album_setting(value, album_names=()):
+    """
+    Parse the album setting into (name, weight) pairs
+
+    Albums are separated by commas and may end with ":<weight>", e.g.
+    "Family:3, Travel". The default weight is 1. An album whose name matches
+    the whole setting or a whole part of it is taken as is, so names such as
+    "Paris, 2019" or "Trip:2019" keep working.
+
+    :param album_names: names of the existing albums
+    """
+    album_names = set(album_names)
+    for name in (str(value), str(value).strip()):
+        if name in album_names:
+            return [(name, 1)]
+    albums = []
+    for part in str(value).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, weight = part, 1
+        head, sep, tail = part.rpartition(':')
+        if sep and head.strip() and tail.strip().isdigit() and part not in album_names:
+            name, weight = head.strip(), max(1, int(tail.strip()))
+        albums.append((name, weight))
+    return albums
+
+
+class SelectionEngine:
+    """ Persisted per-album play orders with an O(1) cursor """
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.lock = threading.Lock()
+        self.states = {}
+        self.assets = {}
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def _write(self, name, content):
+        """ Write a state file atomically """
+        path = self._path(name)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Error writing selection state {path}: {e}")
+
+    def _load(self, album_id):
+        state = self.states.get(album_id)
+        if state is not None:
+            return state
+        try:
+            with open(self._path(f"{album_id}.json"), 'r') as f:
+                state = json.load(f)
+            with open(self._path(f"{album_id}.cursor"), 'r') as f:
+                state['cursor'] = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error reading selection state for {album_id}: {e}")
+            return None
+        self.states[album_id] = state
+        return state
+
+    def _save_order(self, album_id, state):
+        order_state = {key: value for key, value in state.items() if key != 'cursor'}
+        self._write(f"{album_id}.json", json.dumps(order_state))
+        self._save_cursor(album_id, state)
+
+    def _save_cursor(self, album_id, state):
+        self._write(f"{album_id}.cursor", str(state['cursor']))
+
+    def _build_order(self, ids, dates, mode, last_id=None):
+        if mode == 'newest':
+            return sorted(ids, key=lambda asset_id: dates.get(asset_id, DEFAULT_DATE), reverse=True)
+        order = list(ids)
+        random.shuffle(order)
+        # Avoid showing the same photo twice in a row across cycles
+        if len(order) > 1 and order[0] == last_id:
+            order[0], order[-1] = order[-1], order[0]
+        return order
+
+    def needs_sync(self, album_id, fingerprint, mode):
+        """ True when the album listing must be fetched and diffed """
+        with self.lock:
+            state = self._load(album_id)
+            return (state is None or fingerprint is None
+                    or state.get('fingerprint') != fingerprint
+                    or state.get('mode') != mode)
+
+    def sync(self, album_id, assets, fingerprint, mode):
+        """
+        Update the play order of an album from its asset list
+
+        :param album_id: Immich album ID
+        :param assets: asset dictionaries from the Immich album API
+        :param fingerprint: value from album_fingerprint()
+        :param mode: 'random' or 'newest'
+        """
+        with self.lock:
+            by_id = {asset['id']: asset for asset in assets}
+            self.assets[album_id] = by_id
+            state = self._load(album_id)
+
+            if state is None or state.get('mode') != mode:
+                dates = {asset_id: asset_date(asset) for asset_id, asset in by_id.items()}
+                state = {
+                    'mode': mode,
+                    'fingerprint': fingerprint,
+                    'order': self._build_order(by_id, dates, mode),
+                    'dates': dates,
+                    'cursor': 0,
+                }
+                self.states[album_id] = state
+                self._save_order(album_id, state)
+                return
+
+            order = state['order']
+            cursor = state['cursor']
+            known = set(order)
+            removed = known.difference(by_id)
+            added = [asset_id for asset_id in by_id if asset_id not in known]
+            if not removed and not added:
+                if state.get('fingerprint') != fingerprint:
+                    state['fingerprint'] = fingerprint
+                    self._save_order(album_id, state)
+                return
+
+            dates = state.setdefault('dates', {})
+            if removed:
+                # Drop removed assets, keeping the cursor on the same next photo
+                cursor -= sum(1 for asset_id in order[:cursor] if asset_id in removed)
+                order = [asset_id for asset_id in order if asset_id not in removed]
+                for asset_id in removed:
+                    dates.pop(asset_id, None)
+
+            if added:
+                for asset_id in added:
+                    dates[asset_id] = asset_date(by_id[asset_id])
+                if mode == 'newest':
+                    # New photos are shown next, newest first
+                    added.sort(key=lambda asset_id: dates[asset_id], reverse=True)
+                    order[cursor:cursor] = added
+                else:
+                    # Shuffle new photos into the unplayed part of the cycle
+                    tail = order[cursor:] + added
+                    random.shuffle(tail)
+                    order[cursor:] = tail
+
+            state['order'] = order
+            state['cursor'] = min(max(cursor, 0), len(order))
+            state['fingerprint'] = fingerprint
+            print(f"Album {album_id} changed: {len(added)} added, {len(removed)} removed")
+            self._save_order(album_id, state)
+
+    def invalidate(self, album_id):
+        """ Force a resync on the next wake """
+        with self.lock:
+            self.assets.pop(album_id, None)
+            state = self.states.get(album_id)
+            if state is not None:
+                state['fingerprint'] = None
+
+    def advance(self, album_id):
+        """
+        Claim the next asset: move the cursor past it and return its ID
+
+        Atomic, so concurrent wakes each get their own photo. None for an
+        empty album.
+        """
+        with self.lock:
+            state = self._load(album_id)
+            if not state or not state['order']:
+                return None
+            self._wrap(album_id, state)
+            asset_id = state['order'][state['cursor']]
+            state['cursor'] += 1
+            self._save_cursor(album_id, state)
+            return asset_id
+
+    def _wrap(self, album_id, state):
+        """ Start a new cycle once every asset has been shown """
+        if state['cursor'] < len(state['order']):
+            return
+        last_id = state['order'][-1]
+        state['order'] = self._build_order(state['order'], state.get('dates', {}), state['mode'], last_id)
+        state['cursor'] = 0
+        self._save_order(album_id, state)
+
+    def asset(self, album_id, asset_id):
+        """ Cached asset dictionary, None when the album was not synced in this process """
+        return self.assets.get(album_id, {}).get(asset_id)
+
+    def pick_album(self, albums):
+        """
+        Pick the album for this wake with smooth weighted round-robin
+
+        :param albums: (name, weight) pairs from parse_album_setting()
+        :return: album name
+        """
+        if len(albums) == 1:
+            return albums[0][0]
+        with self.lock:
+            key = ','.join(f"{name}:{weight}" for name, weight in albums)
+            try:
+                with open(self._path('rotation.json'), 'r') as f:
+                    rotation = json.load(f)
+            except (OSError, ValueError):
+                rotation = {}
+            current = rotation.get(key, {})
+            total = sum(weight for _, weight in albums)
+            for name, weight in albums:
+                current[name] = current.get(name, 0) + weight
+            chosen = max(albums, key=lambda album: current[album[0]])[0]
+            current[chosen] -= total
+            self._write('rotation.json', json.dumps({key: current}))
+            return chosen
@@ -0,0 +1,23 @@
+# Build the Cython image engine in place:
+#   python setup.py build_ext --inplace
+import numpy as np
+from Cython.Build import cythonize
+from setuptools import Extension, setup
+
+extensions = [
+    Extension(
+        'cpy',
+        ['cpy.pyx'],
+        include_dirs=[np.get_include()],
+        # No fused multiply-add contraction, so results match the NumPy
+        # engine on every architecture (aarch64 contracts by default)
+        # OpenMP runs the ordered dithering rows in parallel (prange)
+        extra_compile_args=['-O3', '-ffp-contract=off', '-fopenmp'],
+        extra_link_args=['-fopenmp'],
+    )
+]
+
+setup(
+    name='epf-cpy',
+    ext_modules=cythonize(extensions, compiler_directives={'language_level': 3}),
+)
@@ -0,0 +1,110 @@
+#-*- coding:utf8 -*-
+"""
+Single-flight request coalescing
+
+Concurrent callers asking for the same key share one computation: the first
+caller (the leader) does the work, the others wait for its result instead of
+repeating it. Used for renders of the same photo with the same settings (a
+frame retrying while its first request still renders) and for Immich album
+listings when several frames wake at once.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+# Seconds a caller waits for the leader before giving up, so one hung call
+# can't block every caller of its key
+WAIT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', '45'))
+
+
+class Flight:
+    """ Result of one computation, shared by every caller of a key """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+    @property
+    def done(self):
+        return self.event.is_set()
+
+    def resolve(self, result):
+        """ Publish the result and release the waiting callers """
+        if not self.done:
+            self.result = result
+            self.event.set()
+
+    def fail(self, error):
+        """ Release the waiting callers with the leader's exception """
+        if not self.done:
+            self.error = error
+            self.event.set()
+
+    def wait(self, timeout=WAIT_TIMEOUT):
+        """
+        Result of the leader, raises the leader's exception if it failed
+
+        Raises TimeoutError when the leader took longer than timeout seconds.
+        """
+        if not self.event.wait(timeout):
+            raise TimeoutError("Timed out waiting for a coalesced request")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """ One Flight per key while it is in progress """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.led = 0
+        self.shared = 0
+
+    @contextmanager
+    def join(self, key):
+        """
+        Join the flight of a key
+
+        Yields (flight, leader). The leader computes the result and hands it to
+        flight.resolve(), possibly before it is done with its own work; the
+        other callers get it from flight.wait(). A leader leaving without a
+        result resolves the flight with None, or fails it with its exception.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.led += 1
+            else:
+                flight.waiters += 1
+                self.shared += 1
+        if not leader:
+            yield flight, False
+            return
+        try:
+            yield flight, True
+        except BaseException as e:
+            flight.fail(e)
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            flight.resolve(None)
+
+    def do(self, key, fn, timeout=WAIT_TIMEOUT):
+        """ Call fn() once for concurrent callers of a key and return its result """
+        with self.join(key) as (flight, leader):
+            if not leader:
+                return flight.wait(timeout)
+            result = fn()
+            flight.resolve(result)
+            return result
+
+    def status(self):
+        """ Number of computations and of callers that shared one """
+        with self.lock:
+            return {'computed': self.led, 'shared': self.shared, 'in_flight': len(self.flights)}
@@ -0,0 +1,477 @@
+#-*- coding:utf8 -*-
+"""
+Fleet load generator
+
+Simulates N ESP32 frames against the server, following the loop in
+Arduino/epd7in3f.ino: every wake sends the battery voltage to /frame, reads
+the frame at the configured Wi-Fi bandwidth and sleeps for the duration in
+its X-Sleep-Duration header, scaled down by --time-scale. With --legacy the
+frames use /download and ask /sleep in a second request like older firmware.
+
+By default the server is started in a separate process against a local fake
+Immich serving generated fixture albums, so no hardware or Immich instance is
+needed:
+
+    python tools/loadgen.py --devices 20 --duration 120
+
+Use --server http://host:port to load an already running server instead
+(its Immich settings are then used as configured).
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Firmware constants (Arduino/config.h)
+RETRY_DELAY = 10.0
+MAX_RETRIES = 5
+HTTP_TIMEOUT = 50.0
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile, None for an empty list """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Response:
+    def __init__(self, status, headers, body, nbytes, ttfb, elapsed):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.nbytes = nbytes
+        self.ttfb = ttfb
+        self.elapsed = elapsed
+
+
+async def http_get(url, headers=None, bandwidth=None, keep_body=True, timeout=HTTP_TIMEOUT):
+    """
+    Minimal HTTP/1.1 GET over asyncio streams
+
+    :param bandwidth: bytes per second the body is consumed at, None for unlimited
+    :param keep_body: False to count the body without keeping it
+    """
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    start = time.monotonic()
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, port, ssl=parts.scheme == 'https' or None), timeout)
+    try:
+        lines = [f"GET {path} HTTP/1.1", f"Host: {parts.netloc}", "Connection: close"]
+        lines += [f"{key}: {value}" for key, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        ttfb = time.monotonic() - start
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            response_headers[key.strip().lower()] = value.strip()
+
+        body = io.BytesIO() if keep_body else None
+        received = 0
+        body_start = time.monotonic()
+
+        async def consume(data):
+            nonlocal received
+            received += len(data)
+            if body is not None:
+                body.write(data)
+            if bandwidth:
+                # Pace reading so the body arrives at the simulated link speed
+                delay = body_start + received / bandwidth - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await asyncio.wait_for(reader.readline(), timeout)).split(b';')[0], 16)
+                if size == 0:
+                    break
+                await consume(await asyncio.wait_for(reader.readexactly(size), timeout))
+                await reader.readline()
+        elif 'content-length' in response_headers:
+            remaining = int(response_headers['content-length'])
+            while remaining > 0:
+                data = await asyncio.wait_for(reader.read(min(remaining, 16384)), timeout)
+                if not data:
+                    raise ConnectionError("Connection closed before the whole body was received")
+                remaining -= len(data)
+                await consume(data)
+        else:
+            while True:
+                data = await asyncio.wait_for(reader.read(16384), timeout)
+                if not data:
+                    break
+                await consume(data)
+
+        return Response(status, response_headers, body.getvalue() if body is not None else b'',
+                        received, ttfb, time.monotonic() - start)
+    finally:
+        writer.close()
+
+
+class FakeImmich:
+    """ Serves fixture albums with generated JPEG originals over the Immich API """
+    def __init__(self, albums, assets_per_album, photo_size, distinct_photos, latency=0.0):
+        self.latency = latency
+        self.originals = self._make_photos(photo_size, distinct_photos)
+        self.albums = {}
+        self.assets = {}
+        base_date = datetime(2024, 1, 1)
+        for album_index in range(albums):
+            album_id = f"album-{album_index}"
+            assets = []
+            for asset_index in range(assets_per_album):
+                asset_id = f"{album_id}-asset-{asset_index}"
+                photo = (album_index * assets_per_album + asset_index) % len(self.originals)
+                asset = {
+                    'id': asset_id,
+                    'originalPath': f"/photos/{asset_id}.jpg",
+                    'exifInfo': {
+                        'dateTimeOriginal': (base_date + timedelta(hours=asset_index)).strftime('%Y-%m-%dT%H:%M:%S'),
+                        'exifImageWidth': photo_size[0],
+                        'exifImageHeight': photo_size[1],
+                        'fileSizeInByte': len(self.originals[photo]),
+                    },
+                }
+                assets.append(asset)
+                self.assets[asset_id] = (asset, photo)
+            self.albums[album_id] = {
+                'id': album_id,
+                'albumName': f"fixture-{album_index}",
+                'assetCount': len(assets),
+                'updatedAt': base_date.isoformat(),
+                'assets': assets,
+            }
+        self.requests = 0
+
+    @staticmethod
+    def _make_photos(photo_size, count):
+        import numpy as np
+        from PIL import Image
+
+        width, height = photo_size
+        rng = np.random.default_rng(0)
+        photos = []
+        for index in range(count):
+            # Smooth color gradients with noise, roughly as hard to compress as a photo
+            x = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+            y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+            phase = index / max(1, count)
+            rgb = np.stack([
+                (np.sin((x + phase) * 6.28) * 0.5 + 0.5) * (1 - y),
+                (np.cos((y + phase) * 6.28) * 0.5 + 0.5) * x,
+                np.abs(x - y),
+            ], axis=2) * 220
+            rgb += rng.normal(0, 12, rgb.shape).astype(np.float32)
+            image = Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8), 'RGB')
+            data = io.BytesIO()
+            image.save(data, 'JPEG', quality=90)
+            photos.append(data.getvalue())
+        return photos
+
+    def album_names(self):
+        return [album['albumName'] for album in self.albums.values()]
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            self.requests += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            path = request_line.split()[1].decode('latin-1').split('?')[0]
+            status, content_type, body = self.route(path)
+            writer.write((f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                          f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    def route(self, path):
+        parts = path.strip('/').split('/')
+        if parts == ['api', 'albums']:
+            listing = [{key: value for key, value in album.items() if key != 'assets'}
+                       for album in self.albums.values()]
+            return '200 OK', 'application/json', json.dumps(listing).encode()
+        if len(parts) == 3 and parts[:2] == ['api', 'albums'] and parts[2] in self.albums:
+            return '200 OK', 'application/json', json.dumps(self.albums[parts[2]]).encode()
+        if len(parts) >= 3 and parts[:2] == ['api', 'assets'] and parts[2] in self.assets:
+            asset, photo = self.assets[parts[2]]
+            if len(parts) == 4 and parts[3] == 'original':
+                return '200 OK', 'image/jpeg', self.originals[photo]
+            if len(parts) == 3:
+                return '200 OK', 'application/json', json.dumps(asset).encode()
+        return '404 Not Found', 'application/json', b'{"error": "Not found"}'
+
+
+def _serve_app(port, immich_url, album, photo_dir):
+    """ Run the Flask server in a child process, configured for the fake Immich """
+    os.environ['IMMICH_PHOTO_DEST'] = photo_dir
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    import app as server
+
+    # Keep the report readable, the request log adds nothing here
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    config = {'immich': dict(server.DEFAULT_CONFIG['immich'], url=immich_url, album=album)}
+    server.update_app_config(config)
+    server.app.run(host='127.0.0.1', port=port, threaded=True, use_reloader=False)
+
+
+async def wait_for_port(port, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server did not start listening on port {port}")
+
+
+class Device:
+    """ One simulated frame and its per-wake measurements """
+    def __init__(self, index, args):
+        self.index = index
+        self.args = args
+        self.battery_mv = random.randint(3900, 4200)
+        self.frame_hash = None
+        self.wakes = []
+
+    async def run(self, deadline):
+        args = self.args
+        # Spread the first wake like frames booted at different times
+        await asyncio.sleep(random.uniform(0, args.ramp))
+        while time.monotonic() < deadline:
+            wake = await self.wake()
+            self.wakes.append(wake)
+            sleep_seconds = wake['sleep_ms'] / 1000.0 if wake['sleep_ms'] else 86400.0
+            await asyncio.sleep(max(args.min_sleep, sleep_seconds * args.time_scale))
+
+    async def wake(self):
+        """ One firmware wake: /frame with retries, or /download then /sleep with --legacy """
+        args = self.args
+        headers = {'batteryCap': str(self.battery_mv), 'panel': args.panel, 'device': f"loadgen-{self.index}"}
+        if self.frame_hash and not args.legacy:
+            headers['If-None-Match'] = self.frame_hash
+        self.battery_mv = max(3400, self.battery_mv - random.randint(0, 3))
+        wake = {'device': self.index, 'download': None, 'ttfb': None, 'sleep': None, 'bytes': 0,
+                'status': None, 'error': None, 'retries': 0, 'requests': 0, 'sleep_ms': 0, 'radio_on': 0.0}
+        start = time.monotonic()
+        retry_on_error = True
+        success = False
+        try:
+            while retry_on_error and not success:
+                retry_on_error = False
+                for attempt in range(MAX_RETRIES):
+                    response = await http_get(args.server + ('/download' if args.legacy else '/frame'), headers,
+                                              bandwidth=args.bandwidth, keep_body=False)
+                    wake['requests'] += 1
+                    wake['status'] = response.status
+                    wake['bytes'] += response.nbytes
+                    if 'x-sleep-duration' in response.headers:
+                        wake['sleep_ms'] = int(response.headers['x-sleep-duration'])
+                    if response.status in (200, 304):
+                        self.frame_hash = response.headers.get('x-frame-hash', self.frame_hash)
+                        wake['download'] = response.elapsed
+                        wake['ttfb'] = response.ttfb
+                        success = True
+                        break
+                    wake['retries'] += 1
+                    if response.status == 202:
+                        await asyncio.sleep(RETRY_DELAY * args.time_scale)
+                    elif response.status == 500:
+                        await asyncio.sleep(RETRY_DELAY * args.time_scale)
+                        retry_on_error = wake['retries'] <= 1
+                        break
+                    else:
+                        break
+
+            if success and args.legacy:
+                response = await http_get(args.server + '/sleep', {'Accept': 'application/json'})
+                wake['requests'] += 1
+                wake['sleep'] = response.elapsed
+                wake['bytes'] += response.nbytes
+                if response.status == 200:
+                    wake['sleep_ms'] = json.loads(response.body).get('sleep_duration', 0)
+        except Exception as e:
+            wake['error'] = f"{type(e).__name__}: {e}"
+
+        # Retry delays are scaled down, the radio stays on for the real delay
+        waited = wake['retries'] * RETRY_DELAY * (1 - args.time_scale)
+        handshakes = wake['requests'] * args.handshake
+        wake['radio_on'] = args.wifi_connect + time.monotonic() - start + waited + handshakes
+        return wake
+
+
+def summarize(devices, elapsed):
+    wakes = [wake for device in devices for wake in device.wakes]
+    ok = [wake for wake in wakes if wake['download'] is not None]
+    failed = [wake for wake in wakes if wake['download'] is None]
+
+    def stats(values):
+        return {f"p{pct}": round(percentile(values, pct), 4) if values else None for pct in (50, 90, 95, 99)}
+
+    status_counts = {}
+    for wake in wakes:
+        key = wake['error'].split(':')[0] if wake['error'] else str(wake['status'])
+        status_counts[key] = status_counts.get(key, 0) + 1
+
+    radio_per_device = [sum(wake['radio_on'] for wake in device.wakes) for device in devices]
+    return {
+        'devices': len(devices),
+        'elapsed_seconds': round(elapsed, 1),
+        'wakes': len(wakes),
+        'frames_per_second': round(len(ok) / elapsed, 3) if elapsed else None,
+        'error_rate': round(len(failed) / len(wakes), 4) if wakes else None,
+        'retries': sum(wake['retries'] for wake in wakes),
+        'results': status_counts,
+        'download_seconds': stats([wake['download'] for wake in ok]),
+        'ttfb_seconds': stats([wake['ttfb'] for wake in ok]),
+        'sleep_seconds': stats([wake['sleep'] for wake in ok if wake['sleep'] is not None]),
+        'requests_per_wake': round(sum(wake['requests'] for wake in wakes) / len(wakes), 2) if wakes else None,
+        'bytes_per_wake': round(sum(wake['bytes'] for wake in wakes) / len(wakes)) if wakes else None,
+        'radio_on_seconds_per_wake': stats([wake['radio_on'] for wake in wakes]),
+        'radio_on_seconds_per_device': {
+            'mean': round(sum(radio_per_device) / len(radio_per_device), 2) if radio_per_device else None,
+            'max': round(max(radio_per_device), 2) if radio_per_device else None,
+        },
+    }
+
+
+def print_report(report):
+    print(f"\n{report['devices']} devices, {report['wakes']} wakes in {report['elapsed_seconds']} s "
+          f"({report['frames_per_second']} frames/s)")
+    print(f"Error rate: {report['error_rate']}  retries: {report['retries']}  results: {report['results']}")
+    print(f"Requests per wake: {report['requests_per_wake']}  bytes per wake: {report['bytes_per_wake']}")
+    for key in ('download_seconds', 'ttfb_seconds', 'sleep_seconds', 'radio_on_seconds_per_wake'):
+        values = '  '.join(f"{pct}={value}" for pct, value in report[key].items())
+        print(f"{key:28s} {values}")
+    device_radio = report['radio_on_seconds_per_device']
+    print(f"{'radio_on_seconds_per_device':28s} mean={device_radio['mean']}  max={device_radio['max']}")
+
+
+async def main_async(args):
+    immich_server = None
+    server_process = None
+    photo_dir = None
+    try:
+        if not args.server:
+            immich = FakeImmich(args.albums, args.assets, args.photo_size, args.distinct_photos, args.immich_latency)
+            immich_server = await asyncio.start_server(immich.handle, '127.0.0.1', 0)
+            immich_url = f"http://127.0.0.1:{immich_server.sockets[0].getsockname()[1]}"
+
+            photo_dir = tempfile.TemporaryDirectory(prefix='epf-loadgen-')
+            port = free_port()
+            album = ', '.join(immich.album_names())
+            context = multiprocessing.get_context('spawn')
+            server_process = context.Process(target=_serve_app, args=(port, immich_url, album, photo_dir.name),
+                                             daemon=True)
+            server_process.start()
+            await wait_for_port(port)
+            args.server = f"http://127.0.0.1:{port}"
+            print(f"Fake Immich at {immich_url}, server at {args.server}", file=sys.stderr)
+
+        devices = [Device(index, args) for index in range(args.devices)]
+        start = time.monotonic()
+        deadline = start + args.duration
+        tasks = [asyncio.create_task(device.run(deadline)) for device in devices]
+        # Let wakes in flight finish, but stop devices sleeping past the deadline
+        done, pending = await asyncio.wait(tasks, timeout=args.duration + HTTP_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        report = summarize(devices, time.monotonic() - start)
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.join(5)
+        if immich_server is not None:
+            immich_server.close()
+        if photo_dir is not None:
+            photo_dir.cleanup()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return report
+
+
+def parse_size(value):
+    width, _, height = value.lower().partition('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of e-paper frames against the server")
+    parser.add_argument('--server', help="URL of a running server, default: start one against a fake Immich")
+    parser.add_argument('--devices', type=int, default=10, help="simulated frames")
+    parser.add_argument('--duration', type=float, default=60.0, help="test length in seconds")
+    parser.add_argument('--time-scale', type=float, default=1 / 3600.0,
+                        help="factor applied to sleep durations (default: one hour becomes one second)")
+    parser.add_argument('--min-sleep', type=float, default=0.5, help="shortest scaled sleep in seconds")
+    parser.add_argument('--ramp', type=float, default=2.0, help="spread the first wakes over this many seconds")
+    parser.add_argument('--bandwidth', type=float, default=250_000,
+                        help="Wi-Fi throughput in bytes/s the frame reads at, 0 for unlimited")
+    parser.add_argument('--wifi-connect', type=float, default=2.0,
+                        help="seconds of radio time per wake spent joining Wi-Fi")
+    parser.add_argument('--handshake', type=float, default=0.0,
+                        help="seconds of radio time per request spent on the TCP/TLS handshake")
+    parser.add_argument('--legacy', action='store_true',
+                        help="use /download and /sleep like firmware without /frame support")
+    parser.add_argument('--panel', default='epd7in3f', help="panel header sent by the frames")
+    parser.add_argument('--albums', type=int, default=1, help="fixture albums (fake Immich)")
+    parser.add_argument('--assets', type=int, default=50, help="assets per fixture album (fake Immich)")
+    parser.add_argument('--photo-size', type=parse_size, default=(4000, 3000), help="fixture photo size WxH")
+    parser.add_argument('--distinct-photos', type=int, default=4, help="different fixture JPEGs to generate")
+    parser.add_argument('--immich-latency', type=float, default=0.0, help="added latency per Immich request")
+    parser.add_argument('--seed', type=int, default=None, help="random seed for reproducible runs")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    args.bandwidth = args.bandwidth or None
+    if args.server:
+        args.server = args.server.rstrip('/')
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+#-*- coding:utf8 -*-
+"""
+Album warm-up job
+
+Renders every photo of the configured albums into the frame store ahead of
+time, so wakes after a settings or album change are served from the store
+instead of paying a full download, decode and dither each.
+
+Sources are fetched by a few threads at a time and rendered in a process
+pool, one process per core. Every photo reserves its estimated peak memory
+in the render budget while it renders, so warm-up renders and wakes share
+RENDER_MEMORY_BUDGET_MB, and with a budget the pool has one process unless
+WARMUP_WORKERS says otherwise. Rendered frames are written to the
+store as they complete, so a new run skips the photos that are already
+stored. A job that died with the server is not restarted automatically: if
+it ran out of memory, restarting it on every startup would crash-loop.
+"""
+import json
+import os
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from memory_budget import budget_enabled, render_budget
+
+# Sources downloaded at the same time
+FETCH_CONCURRENCY = int(os.getenv('WARMUP_FETCH_CONCURRENCY', '4'))
+
+# Render processes, one per core by default, one when a memory budget is set
+# (every process imports the whole app next to the photo it decodes)
+RENDER_WORKERS = int(os.getenv('WARMUP_WORKERS', '0')) or (1 if budget_enabled() else os.cpu_count() or 1)
+
+
+class WarmupJob:
+    """
+    One warm-up run at a time, with progress, throughput and ETA
+
+    :param state_path: file recording the state of the last job
+    :param store: FrameStore the frames are written to
+    """
+    def __init__(self, state_path, store):
+        self.state_path = state_path
+        self.store = store
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.state = {'status': 'idle'}
+
+    def recover(self):
+        """
+        Load the state of the last job at server startup
+
+        A job still marked running died with the server, possibly killed for
+        running out of memory, so it is reported as interrupted instead of
+        being started again.
+        """
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            self.state = state
+            if state.get('status') == 'running':
+                print("Warm-up was interrupted by a server stop, it is not resumed automatically; "
+                      "start it again to render the remaining photos")
+                state['status'] = 'interrupted'
+                state['eta_seconds'] = None
+                self._save_state()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            print(f"Error writing warm-up state {self.state_path}: {e}")
+
+    def start(self, list_assets, fetch, render, fingerprints, frame_id=None, estimate=None, initializer=None,
+              initargs=(), trigger='manual'):
+        """
+        Start a job in the background
+
+        :param list_assets: callable returning (source, assets) to warm up
+        :param fetch: callable(source, asset) returning what render needs to read the photo
+        :param render: picklable callable(data, original_path, panel_names) run in the pool,
+                       returning one frame of palette indices per panel
+        :param fingerprints: render fingerprints, one per panel, first item the panel name
+        :param frame_id: callable(asset) returning the store ID of a photo, its asset ID by default
+        :param estimate: callable(asset) returning the peak bytes of rendering a photo, reserved
+                         in the render budget while it renders
+        :param initializer: called with initargs in every render process
+        :return: False when a job is already running
+        """
+        with self.lock:
+            if self.running():
+                return False
+            self.stop_event.clear()
+            self.state = {
+                'status': 'running',
+                'trigger': trigger,
+                'started': time.time(),
+                'panels': [fingerprint[0] for fingerprint in fingerprints],
+                'total': 0, 'rendered': 0, 'cached': 0, 'failed': 0,
+                'rate': 0.0, 'eta_seconds': None,
+            }
+            self._save_state()
+            self.thread = threading.Thread(
+                target=self._run,
+                args=(list_assets, fetch, render, fingerprints, frame_id or (lambda asset: asset['id']),
+                      estimate or (lambda asset: 0), initializer, initargs),
+                daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """ Stop after the renders in progress, a stopped job is not resumed """
+        self.stop_event.set()
+
+    def _finish(self, status, error=None):
+        with self.lock:
+            self.state['status'] = status
+            self.state['finished'] = time.time()
+            if error:
+                self.state['error'] = error
+            self.state['eta_seconds'] = None
+            self._save_state()
+        print(f"Warm-up {status}: {self.state['rendered']} rendered, {self.state['cached']} already stored, "
+              f"{self.state['failed']} failed")
+
+    def _run(self, list_assets, fetch, render, fingerprints, frame_id, estimate, initializer, initargs):
+        try:
+            source, assets = list_assets()
+        except Exception as e:
+            self._finish('failed', f"Listing photos failed: {e}")
+            return
+
+        # Frames of photos that left the album or were replaced are never served again,
+        # an empty listing (e.g. album not found) keeps them
+        if assets:
+            listed = {frame_id(asset) for asset in assets}
+            removed = self.store.remove_missing(fingerprints, source, listed)
+            if removed:
+                print(f"Warm-up: removed {removed} stored frames of photos no longer listed")
+
+        # Photos already stored for every panel are done, which makes the job resumable
+        pending = []
+        for asset in assets:
+            if all(self.store.contains(fingerprint, source, frame_id(asset)) for fingerprint in fingerprints):
+                self.state['cached'] += 1
+            else:
+                pending.append(asset)
+        self.state['total'] = len(assets)
+        print(f"Warm-up: {len(pending)} of {len(assets)} photos to render for {', '.join(self.state['panels'])}")
+
+        panel_names = [fingerprint[0] for fingerprint in fingerprints]
+        render_started = time.time()
+        fetch_slots = threading.Semaphore(FETCH_CONCURRENCY)
+        # Photos rendering at once, only these hold a budget reservation
+        render_slots = threading.Semaphore(RENDER_WORKERS)
+
+        def warm(pool, asset):
+            if self.stop_event.is_set():
+                return
+            try:
+                # Bounded downloads, the render processes stay busy meanwhile
+                with fetch_slots:
+                    data = fetch(source, asset)
+                with render_slots:
+                    # Wakes and warm-up renders share the memory budget
+                    nbytes = estimate(asset)
+                    while not render_budget.acquire(nbytes):
+                        if self.stop_event.is_set():
+                            return
+                    try:
+                        frames = pool.submit(render, data, asset['originalPath'], panel_names).result()
+                    finally:
+                        render_budget.release(nbytes)
+                del data
+                for fingerprint, frame in zip(fingerprints, frames):
+                    self.store.save(fingerprint, source, frame_id(asset), frame)
+                result = 'rendered'
+            except Exception as e:
+                print(f"Warm-up failed for {asset.get('originalFileName', asset['id'])}: {e}")
+                result = 'failed'
+            with self.lock:
+                self.state[result] += 1
+                done = self.state['rendered'] + self.state['failed']
+                elapsed = time.time() - render_started
+                self.state['rate'] = round(done / elapsed, 2) if elapsed > 0 else 0.0
+                self.state['eta_seconds'] = (round((len(pending) - done) / self.state['rate'])
+                                             if self.state['rate'] > 0 else None)
+
+        try:
+            # Spawned processes don't inherit the server's threads and locks
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(RENDER_WORKERS, mp_context=context,
+                                     initializer=initializer, initargs=initargs) as pool, \
+                 ThreadPoolExecutor(FETCH_CONCURRENCY + RENDER_WORKERS) as threads:
+                for _ in threads.map(lambda asset: warm(pool, asset), pending):
+                    pass
+        except Exception as e:
+            self._finish('failed', str(e))
+            return
+        self._finish('stopped' if self.stop_event.is_set() else 'done')
+
+    def status(self):
+        """ Progress of the current or last job """
+        with self.lock:
+            status = dict(self.state)
+        if status['status'] == 'running' and status.get('started'):
+            status['elapsed_seconds'] = round(time.time() - status['started'])
+        status['workers'] = RENDER_WORKERS
+        status['fetch_concurrency'] = FETCH_CONCURRENCY
+        return status